@@ -0,0 +1,403 @@
+from clashdog import AddRules, Builder, SafeLoader, iterRules
+
+# 标准库
+import argparse
+import ipaddress
+import logging
+import random
+import time
+import tracemalloc
+import types
+import zlib
+
+from urllib.parse import urlparse
+
+# 第三方库
+import yaml
+
+# 与 config.yaml 中的 Policy 对应：policy: disable-udp
+POLICIES = {"DIRECT": False, "REJECT": False, "A": False, "B": True, "G": False}
+
+# 规则类型及其占比
+KINDS = {
+    "DOMAIN-SUFFIX": 40,
+    "DOMAIN": 20,
+    "DOMAIN-KEYWORD": 2,
+    "IP-CIDR": 25,
+    "IP-CIDR6": 4,
+    "SRC-IP-CIDR": 2,
+    "DST-PORT": 3,
+    "PROCESS-NAME": 2,
+    "GEOIP": 2,
+}
+
+MIXES = ("domain", "ip", "udp", "match")
+
+
+###############################################################
+# 在 CPython 中模拟 starlark-go 的执行环境
+###############################################################
+def starlarkType(x):
+    if isinstance(x, bool):
+        return "bool"
+    if isinstance(x, str):
+        return "string"
+    if isinstance(x, (types.BuiltinFunctionType, types.MethodType)):
+        return "builtin_function_or_method"
+    if isinstance(x, types.FunctionType):
+        return "function"
+    return "NoneType" if x is None else type(x).__name__
+
+
+def load(source):
+    g = {
+        "type": starlarkType,
+        "time": types.SimpleNamespace(now=time.time, microsecond=1e-6),
+    }
+    exec(compile(source, "rules.star", "exec"), g)
+    # str 没有 elem_ords 等方法，替换脚本中的包装函数
+    g["elem_ords"] = lambda s: list(s.encode("utf-8"))
+    g["codepoint_ords"] = lambda s: [ord(c) for c in s]
+    g["codepoints"] = list
+    return g
+
+
+class Proxy:
+    def __init__(self, name, alive=True, delay=0):
+        self.name = name
+        self.alive = alive
+        self.delay = delay
+
+
+# 模拟 Clash Premium 中脚本的 ctx，结果只取决于输入，便于重复测量
+class Context:
+    def __init__(self, policies, processes):
+        self.proxy_providers = {"default": [Proxy(x) for x in policies]}
+        self.processes = processes
+        self.logs = 0
+
+    def geoip(self, ip):
+        return "CN" if zlib.crc32(ip.encode()) % 4 == 0 else "US"
+
+    def resolve_ip(self, host):
+        return str(ipaddress.IPv4Address(zlib.crc32(host.encode())))
+
+    def resolve_process_name(self, metadata):
+        return self.processes[int(metadata["src_port"]) % len(self.processes)]
+
+    def log(self, message):
+        self.logs += 1
+
+
+###############################################################
+# 生成规则及连接
+###############################################################
+def synthesize(n, rng):
+    rules = []
+    kinds, weights = list(KINDS), list(KINDS.values())
+    for i, kind in enumerate(rng.choices(kinds, weights, k=n - 1)):
+        if kind in ("DOMAIN-SUFFIX", "DOMAIN"):
+            value = f"s{i}.example{rng.randrange(100)}.com"
+        elif kind == "DOMAIN-KEYWORD":
+            value = f"kw{i}x"
+        elif kind == "IP-CIDR":
+            prefix = rng.randint(16, 32)
+            value = ipaddress.IPv4Network((rng.getrandbits(32), prefix), False)
+        elif kind == "IP-CIDR6":
+            prefix = rng.randint(48, 64)
+            value = ipaddress.IPv6Network(
+                ((0x20010DB8 << 96) | rng.getrandbits(96), prefix), False
+            )
+        elif kind == "SRC-IP-CIDR":
+            value = f"192.168.{rng.randrange(256)}.0/24"
+        elif kind == "DST-PORT":
+            value = rng.randint(1, 65535)
+        elif kind == "PROCESS-NAME":
+            value = f"proc{i}"
+        else:
+            value = rng.choice(["CN", "US", "LAN"])
+
+        rule = f"{kind},{value},{rng.choice(list(POLICIES))}"
+        if "IP" in kind and rng.random() < 0.5:
+            rule += ",no-resolve"
+        rules.append(rule)
+
+    rules.append("MATCH,G")
+    return rules
+
+
+def render(rules, profile=0):
+    AddRules._Rules = [None]
+    AddRules(
+        types.SimpleNamespace(
+            push=0,
+            filter=["off"],
+            text="rules:\n" + "".join(f"  - {x}\n" for x in rules),
+            policies=POLICIES,
+            defaultPolicy="DIRECT",
+            url=urlparse("file:///benchmark"),
+        )
+    )
+    return Builder.render(profile)
+
+
+# 订阅中 proxies 及 proxy-groups 通常占大部分体积，rules 只是其中一节
+def subscription(rules, proxies, rng):
+    lines = ["port: 7890", "mode: rule", "proxies:"]
+    for i in range(proxies):
+        lines += [
+            f"  - name: \"p{i} {rng.choice(['HK', 'JP', 'US', 'SG'])}\"",
+            "    type: vmess",
+            f"    server: s{i}.example{rng.randrange(100)}.com",
+            f"    port: {rng.randint(1024, 65535)}",
+            f"    uuid: {rng.getrandbits(128):032x}",
+            "    alterId: 0",
+            "    cipher: auto",
+            "    network: ws",
+            "    ws-opts:",
+            f"      path: /p{i}",
+            "      headers:",
+            f"        Host: s{i}.example.com",
+        ]
+    lines.append("proxy-groups:")
+    for i in range(20):
+        lines += [f"  - name: G{i}", "    type: select", "    proxies:"]
+        lines += [f'      - "p{j}"' for j in range(i, proxies, 2)]
+    lines.append("rules:")
+    lines += [f"  - {x}" for x in rules]
+    return "\n".join(lines) + "\n"
+
+
+def address(ipnet, rng):
+    # IPNet => [network, mask, family]
+    network, mask, family = ipnet
+    value = network | rng.getrandbits(8 * family) & ~mask
+    if family == 4:
+        return str(ipaddress.IPv4Address(value & 0xFFFFFFFF))
+    return str(ipaddress.IPv6Address(value))
+
+
+# 连接从脚本中的 RULES 取样，同样适用于已部署的 rules.star
+def connections(rules, mix, n, rng):
+    domains = [x[2] for x in rules if x[1] in ("DOMAIN", "DOMAIN-SUFFIX")]
+    nets = [x[2] for x in rules if x[1] in ("IP-CIDR", "IP-CIDR6")]
+
+    out = []
+    for i in range(n):
+        metadata = {
+            "type": "SOCKS5",
+            "network": "udp" if mix == "udp" else "tcp",
+            "host": "",
+            "src_ip": f"192.168.1.{rng.randrange(1, 255)}",
+            "src_port": str(rng.randint(1024, 65535)),
+            "dst_ip": "",
+            "dst_port": str(rng.choice([80, 443, rng.randint(1, 65535)])),
+        }
+
+        # 八成命中规则，其余落到 MATCH
+        hit = mix != "match" and rng.random() < 0.8
+        if mix == "domain" or mix == "udp" and i % 2 or not nets:
+            if hit and domains:
+                metadata["host"] = rng.choice(["", "www."]) + rng.choice(domains)
+            else:
+                metadata["host"] = f"miss{i}.invalid"
+        elif hit:
+            metadata["dst_ip"] = address(rng.choice(nets), rng)
+        else:
+            metadata["dst_ip"] = str(ipaddress.IPv4Address(rng.getrandbits(32)))
+        out.append(metadata)
+    return out
+
+
+###############################################################
+# 测量
+###############################################################
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def measure(g, mix, n, rng):
+    rules = g["RULES"]
+    policies = {x[2] if x[1] == "MATCH" else x[3] for x in rules} | set(POLICIES)
+    processes = [f"/usr/bin/{x[2]}" for x in rules if x[1] == "PROCESS-NAME"]
+    ctx = Context(sorted(policies), processes + ["/usr/bin/curl"] * 9)
+
+    main = g["main"]
+    conns = connections(rules, mix, n, rng)
+    # 预热
+    for metadata in conns[: n // 10]:
+        main(ctx, dict(metadata))
+
+    samples = []
+    for metadata in conns:
+        metadata = dict(metadata)
+        start = time.perf_counter()
+        main(ctx, metadata)
+        samples.append((time.perf_counter() - start) * 1e9)
+    samples.sort()
+    return sum(samples) / len(samples), samples
+
+
+def report(name, g, args):
+    for mix in args.mix:
+        mean, samples = measure(g, mix, args.connections, random.Random(args.seed))
+        print(
+            f"{name:>10} {mix:>6} {len(samples):>7} {mean:>10.0f}"
+            + "".join(f" {percentile(samples, p):>10.0f}" for p in (0.5, 0.9, 0.99, 1))
+        )
+
+
+# iterRules 只解析 `rules:` 部分，完整加载作为对照
+LOADERS = {
+    "iterRules": lambda text: list(iterRules(text)),
+    SafeLoader.__name__: lambda text: yaml.load(text, Loader=SafeLoader)["rules"],
+    "SafeLoader": lambda text: yaml.load(text, Loader=yaml.SafeLoader)["rules"],
+    "Loader": lambda text: yaml.load(text, Loader=yaml.Loader)["rules"],
+}
+
+
+def reportLoaders(name, text, args):
+    expected = None
+    for loader, loadRules in LOADERS.items():
+        samples = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            rules = loadRules(text)
+            samples.append((time.perf_counter() - start) * 1e3)
+
+        expected = expected or rules
+        assert rules == expected, f"{loader} returned different rules"
+
+        tracemalloc.start()
+        loadRules(text)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print(
+            f"{name:>10} {loader:>12} {len(text):>10} {len(rules):>7}"
+            f" {sum(samples) / len(samples):>10.1f} {min(samples):>10.1f}"
+            f" {peak / 1e6:>10.1f}"
+        )
+
+
+def argvparse():
+    parser = argparse.ArgumentParser(
+        description="Offline match latency benchmark for generated rules.star scripts, run from the clashdog directory."
+    )
+    parser.add_argument(
+        "-f",
+        "--filename",
+        action="append",
+        default=[],
+        help="benchmark existing scripts instead of synthetic rule sets",
+        metavar="rules.star",
+    )
+    parser.add_argument(
+        "-s",
+        "--size",
+        action="append",
+        type=int,
+        help="synthetic rule set sizes, default 1000, 10000 and 100000",
+        metavar=1000,
+    )
+    parser.add_argument(
+        "-m",
+        "--mix",
+        action="append",
+        choices=MIXES,
+        help="connection mixes, default all",
+    )
+    parser.add_argument(
+        "-n",
+        "--connections",
+        default=20000,
+        type=int,
+        help="connections per mix",
+        metavar=20000,
+    )
+    parser.add_argument(
+        "--profile",
+        default=0,
+        type=int,
+        help="render synthetic rule sets with clashdog --profile",
+        metavar=0,
+    )
+    parser.add_argument("--seed", default=0, type=int, help="random seed", metavar=0)
+    parser.add_argument(
+        "-l",
+        "--loader",
+        action="store_true",
+        help="compare iterRules with full YAML loads instead of measuring match",
+    )
+    parser.add_argument(
+        "-y",
+        "--yaml",
+        action="append",
+        default=[],
+        help="subscriptions for --loader instead of synthetic ones",
+        metavar="config.yaml",
+    )
+    parser.add_argument(
+        "-p",
+        "--proxies",
+        default=3000,
+        type=int,
+        help="proxies in synthetic subscriptions for --loader",
+        metavar=3000,
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        default=3,
+        type=int,
+        help="loads per loader for --loader",
+        metavar=3,
+    )
+
+    args = parser.parse_args()
+    args.mix = args.mix or list(MIXES)
+    if not (args.filename or args.loader and args.yaml):
+        args.size = args.size or [1000, 10000, 100000]
+    return args
+
+
+def loaders(args):
+    print(
+        f"{'rules':>10} {'loader':>12} {'bytes':>10} {'count':>7}"
+        f" {'mean(ms)':>10} {'min':>10} {'peak(MB)':>10}"
+    )
+    for fileName in args.yaml:
+        with open(fileName, encoding="utf-8") as stream:
+            reportLoaders(fileName, stream.read(), args)
+
+    for size in args.size or []:
+        rng = random.Random(args.seed)
+        text = subscription(synthesize(size, rng), args.proxies, rng)
+        reportLoaders(size, text, args)
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    args = argvparse()
+    if args.loader:
+        return loaders(args)
+
+    print(
+        f"{'rules':>10} {'mix':>6} {'conns':>7} {'mean(ns)':>10}"
+        f" {'p50':>10} {'p90':>10} {'p99':>10} {'max':>10}"
+    )
+    for fileName in args.filename:
+        with open(fileName, encoding="utf-8") as stream:
+            report(fileName, load(stream.read()), args)
+
+    for size in args.size or []:
+        start = time.perf_counter()
+        source = render(synthesize(size, random.Random(args.seed)), args.profile)
+        logging.warning(
+            f"{size} rules: {len(source)} bytes in {time.perf_counter() - start:.1f} s"
+        )
+        report(size, load(source), args)
+
+
+if __name__ == "__main__":
+    main()
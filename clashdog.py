@@ -1,18 +1,24 @@
-from scriptcat import ParseCIDR
+from scriptcat import ParseCIDR, foldRunes, networkNumberAndMask
 
 # 标准库
 import argparse
 import ast
 import asyncio
 import errno
+import functools
+import gzip
+import hashlib
+import json
 import logging
 import os
 import re
 import socket
 import sys
 import sysconfig
+import time
 
 from asyncio import events, coroutines, tasks
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, urlunparse, unquote
 from pathlib import Path
 
@@ -21,12 +27,17 @@ import requests
 import yaml
 import astor
 
-from requests import put
 from requests.adapters import HTTPAdapter
 from requests_file import FileAdapter
-from urllib3.util.retry import Retry
+from urllib3.util.request import ACCEPT_ENCODING
 from watchdog.observers import Observer
 
+# 优先使用 libyaml，订阅动辄数 MB，纯 Python 的解析器需要数秒
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 if os.name == "nt" and sysconfig.get_platform().startswith("mingw"):
     from watchdog.observers.polling import PollingObserver as Observer
 
@@ -34,49 +45,99 @@ from watchdog.events import FileSystemEventHandler
 
 
 class BaseInsert:
+    _Fetcher = None
+    _Builder = None
+
     def onLoopInit(self):
         pass
 
+    # 条件请求的请求头
+    def conditions(self):
+        return {}
+
     async def load(self):
-        self.policies = {"DIRECT": False, "REJECT": False}  # policy: disable-udp
+        start = time.perf_counter()
+
+        # config.yaml 未变化时沿用上次的 Policy 及控制器地址，避免反复解析域名
+        stat = os.stat(self.configPath)
+        if (stat.st_mtime_ns, stat.st_size) != self.configStat:
+            self.configStat = (stat.st_mtime_ns, stat.st_size)
+            self.policies = {"DIRECT": False, "REJECT": False}  # policy: disable-udp
 
-        # 读取配置
-        with open(self.configPath) as stream:
-            config = yaml.load(stream, Loader=yaml.Loader)
+            # 读取配置
+            with open(self.configPath) as stream:
+                config = yaml.load(stream, Loader=SafeLoader)
 
-            for p in config.get("proxies", []):
-                p = DictObj(p)
-                self.policies[p.name] = not p.udp if "udp" in p else True
+                for p in config.get("proxies", []):
+                    p = DictObj(p)
+                    self.policies[p.name] = not p.udp if "udp" in p else True
 
-            for p in config.get("proxy-groups", []):
-                p = DictObj(p)
-                self.policies[p.name] = p.disable_udp if "disable-udp" in p else False
+                for p in config.get("proxy-groups", []):
+                    p = DictObj(p)
+                    self.policies[p.name] = (
+                        p.disable_udp if "disable-udp" in p else False
+                    )
 
-            addr = urlparse(f"http://{config.get('external-controller', self.extCtrl)}")
-            self.extCtrl = f"{socket.getfqdn(addr.hostname or '')}:{addr.port}"
+                addr = urlparse(
+                    f"http://{config.get('external-controller', self.extCtrl)}"
+                )
+                self.extCtrl = f"{socket.getfqdn(addr.hostname or '')}:{addr.port}"
 
-        logging.debug(self.policies)
+            logging.debug(self.policies)
+
+        logging.debug(f"{urlunparse(self.url)} config {elapsed(start)} ms")
 
         # 发送请求
-        resp = await asyncio.get_event_loop().run_in_executor(None, get, self.url)
+        start = time.perf_counter()
+        resp = await BaseInsert._Fetcher.get(self.url, self.conditions())
+        logging.debug(
+            f"{urlunparse(self.url)} fetch {resp.status_code} {elapsed(start)} ms"
+            f" {resp.headers.get('content-encoding', 'identity')}"
+        )
+
+        # 304 时由子类复用缓存的内容
+        self.notModified = resp.status_code == 304
+        if self.notModified:
+            return
 
         self.encoding = resp.encoding
         self.text = resp.text
         self.headers = resp.headers
 
-    async def save(self):
-        script = astor.parse_file("scriptcat.py")
-        script = ast.fix_missing_locations(AddRules(self).visit(script))
-        script = ast.fix_missing_locations(RewriteRules().visit(script))
+    # 比较原文及其中 `rules:` 部分的摘要，返回是否需要保存并重载
+    def fingerprint(self):
+        start = time.perf_counter()
 
-        with open(
-            fileRotate(self.rotateFileName, self.fileMaxRotate),
-            "w",
-            encoding="utf-8",
-            newline="\n",
-        ) as stream:
-            stream.write(astor.to_source(script))
-            # stream.write(f"\n'''\n{astor.dump_tree(script)}\n'''\n")
+        body, block = self.bodyDigest, self.blockDigest
+        # 304 时内容与上次相同，无需重新计算
+        if not (self.notModified and body):
+            body = hashlib.sha256(self.text.encode("utf-8")).hexdigest()
+            block = rulesBlock(self.text) or self.text
+            block = hashlib.sha256(block.encode("utf-8")).hexdigest()
+
+        # 影响解析结果的不只是规则本身，还有 config.yaml 中的 Policy 及过滤条件
+        rules = repr(
+            (block, sorted(self.policies.items()), self.defaultPolicy, self.filter)
+        )
+        rules = hashlib.sha256(rules.encode("utf-8")).hexdigest()
+
+        changed = body != self.bodyDigest or rules != self.rulesDigest
+        self.rulesChanged = rules != self.rulesDigest
+        self.bodyDigest, self.blockDigest, self.rulesDigest = body, block, rules
+
+        if not changed:
+            logging.info(
+                f"skip {urlunparse(self.url)}: content unchanged ({elapsed(start)} ms)"
+            )
+        elif not self.rulesChanged:
+            logging.info(
+                f"skip {urlunparse(self.url)} rules: rules unchanged ({elapsed(start)} ms)"
+            )
+        return changed
+
+    # 返回是否有文件发生变化，未变化时无需重载
+    async def save(self):
+        return False
 
     async def next(self):
         pass
@@ -86,8 +147,6 @@ class BaseInsert:
         self.url = currentInsert.url
 
         self.defaultPolicy = argv.default_policy
-        self.rotateFileName = abspath(argv.filename)
-        self.fileMaxRotate = argv.file_max_rotate
         self.extCtrl = f"0.0.0.0:{argv.port}"
         self.configPath = abspath(argv.config_file)
 
@@ -98,27 +157,80 @@ class BaseInsert:
             index if currentInsert.push == "back" else 0,
         )
 
+        self.bodyDigest = self.blockDigest = self.rulesDigest = None
+        self.configStat = None
+        self.rulesChanged = True
+
         self.onLoopInit()
 
         while True:
             await self.load()
-            await self.save()
-
-            # 重载配置
-            logging.info("reload configuration")
-            # 本地速度快不需要异步
-            # clash 本身就支持软链接，但必须是完整路径
-            resp = put(
-                f"http://{self.extCtrl}/configs?force=true",
-                json={"path": self.configPath},
-            )
-            # 失败应当终止程序
-            assert resp.ok, f"{resp.text} {self.configPath}"
+
+            # 内容未变化时无需解析、生成及重载
+            if self.fingerprint():
+                start = time.perf_counter()
+                if self.rulesChanged:
+                    AddRules(self)
+                changed = await self.save()
+                logging.debug(f"{urlunparse(self.url)} save {elapsed(start)} ms")
+
+                # 由 Builder 统一生成及重载
+                BaseInsert._Builder.publish(self, self.rulesChanged, changed)
 
             await self.next()
 
 
 class HTTPInsert(BaseInsert):
+    # 缓存的响应头，304 时通常不会再次返回
+    CacheHeaders = (
+        "etag",
+        "last-modified",
+        "content-disposition",
+        "profile-update-interval",
+    )
+
+    def __cacheName(self):
+        # 请求前无法得知文件名，以订阅地址区分
+        digest = hashlib.sha1(urlunparse(self.url).encode("utf-8")).hexdigest()
+        return f".{digest[:16]}.cache"
+
+    def __loadCache(self):
+        try:
+            with open(self.__cacheName(), encoding="utf-8") as stream:
+                cache = json.load(stream)
+        except (OSError, ValueError):
+            return None
+        # 缓存的文件不存在时重新下载
+        return cache if os.path.isfile(cache.get("fileName", "")) else None
+
+    def __dumpCache(self):
+        with open(self.__cacheName(), "w", encoding="utf-8") as stream:
+            json.dump(
+                {
+                    "fileName": self.savePath,
+                    # 与 save 写入文件时使用的编码一致
+                    "encoding": self.encoding or "utf-8",
+                    "headers": {
+                        k: self.headers[k]
+                        for k in HTTPInsert.CacheHeaders
+                        if k in self.headers
+                    },
+                },
+                stream,
+            )
+
+    def conditions(self):
+        cache = self.__loadCache()
+        if not cache:
+            return {}
+
+        headers = {}
+        if "etag" in cache["headers"]:
+            headers["If-None-Match"] = cache["headers"]["etag"]
+        if "last-modified" in cache["headers"]:
+            headers["If-Modified-Since"] = cache["headers"]["last-modified"]
+        return headers
+
     def __fileName(self):
         # 忽略大小写
         return re.findall(
@@ -131,16 +243,51 @@ class HTTPInsert(BaseInsert):
     async def load(self):
         await super().load()
 
+        if self.notModified:
+            cache = self.__loadCache()
+            assert cache, f"{self.__cacheName()} is missing"
+            # 旧的缓存可能记录了 null，文件实际按 utf-8 写入
+            self.encoding = cache["encoding"] or "utf-8"
+            # 只在首次加载时读取文件，之后内存中的内容即为缓存
+            if not self.bodyDigest:
+                with openFile(cache["fileName"], "r", encoding=self.encoding) as stream:
+                    self.text = stream.read()
+            self.headers = requests.structures.CaseInsensitiveDict(cache["headers"])
+
         self.fileName = self.__fileName()
+        self.savePath = f"{self.fileName}.gz" if self.compress else self.fileName
         self.interval = self.__interval()
 
+    def fingerprint(self):
+        changed = super().fingerprint()
+        # 内容未变化时仅更新缓存的响应头，保证缓存与文件一致
+        if not changed and not self.notModified:
+            self.__dumpCache()
+        return changed
+
     async def save(self):
-        await super().save()
+        changed = await super().save()
+
+        # 比较与写入使用同一编码，否则未声明编码时写入的是本地默认编码
+        encoding = self.encoding or "utf-8"
+        if (
+            fileDigest(self.savePath)
+            == hashlib.sha256(self.text.encode(encoding)).digest()
+        ):
+            self.__dumpCache()
+            return changed
 
-        with open(self.fileName, "w", encoding=self.encoding, newline="\n") as stream:
+        with openFile(self.savePath, "w", encoding=encoding, newline="\n") as stream:
             stream.write(self.text)
+        self.__dumpCache()
 
-        logging.info(f"saved file to {abspath(self.fileName)}")
+        logging.info(f"saved file to {abspath(self.savePath)}")
+        return True
+
+    async def loop(self, currentInsert, argv):
+        # 压缩后 clash 无法直接引用，需要时再开启
+        self.compress = "cache" in argv.compress
+        await super().loop(currentInsert, argv)
 
     async def next(self):
         logging.info(f"{self.fileName} next update in {self.interval} hours")
@@ -196,17 +343,220 @@ class FileInsert(BaseInsert, FileSystemEventHandler, asyncio.Event):
         obs.start()
         logging.debug(obs._watches)
 
+    def __stat(self):
+        try:
+            stat = os.stat(self.__fileName())
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    async def loop(self, currentInsert, argv):
+        self.quietPeriod = argv.quiet_period
+        await super().loop(currentInsert, argv)
+
     async def next(self):
+        # 处理期间收到的事件会保留，之后只触发一次更新
         await self.wait()
-        self.clear()
+
+        # 静默期内没有新的事件，且大小及修改时间不再变化时才认为写入完成
+        stat = self.__stat()
+        while True:
+            self.clear()
+            try:
+                await asyncio.wait_for(self.wait(), self.quietPeriod)
+            except asyncio.TimeoutError:
+                current = self.__stat()
+                if current is not None and current == stat:
+                    break
+                # 连续两次不存在时视为文件已被删除，不再等待
+                if current is None and stat is None:
+                    logging.warning(f"{self.__fileName()} is gone")
+                    break
+                stat = current
+            else:
+                stat = self.__stat()
 
     def on_modified(self, event):
         logging.debug(event)
         self._loop.call_soon_threadsafe(self.set)
 
 
+class Builder:
+    # 合并各订阅的更新，只生成一次脚本并重载一次配置
+    def __init__(self, argv):
+        self.rotateFileName = abspath(argv.filename)
+        self.fileMaxRotate = argv.file_max_rotate
+        self.compress = "history" in argv.compress
+        self.configPath = abspath(argv.config_file)
+        self.debounce = argv.debounce
+        self.reloadInterval = argv.reload_interval
+        self.profile = argv.profile
+        self.hits = None
+        if argv.reorder:
+            profile = Profile()
+            for line in argv.reorder:
+                profile.feed(line)
+            self.hits = profile.hitCounts()
+            logging.info(f"reorder by {sum(self.hits.values())} hits")
+
+        self.count = len(argv.insert)
+        self.ready = set()
+        self.build = self.reload = False
+        self.reloadTime = None
+        self.event = asyncio.Event()
+
+    def publish(self, insert, build, reload):
+        self.ready.add(insert.push)
+        self.build |= build
+        self.reload |= reload
+        self.extCtrl = insert.extCtrl
+        self.event.set()
+
+    # 由 AddRules._Rules 生成脚本源码，profile 为采样间隔，0 表示不插桩
+    # hits 为 {original_rule_string: 命中次数}，用于将热点规则前移
+    # optimize 为 False 时不做常量折叠及裁剪，用于对比两者的匹配结果
+    @staticmethod
+    def render(profile=0, hits=None, optimize=True):
+        script = astor.parse_file("scriptcat.py")
+        addRules = AddRules(profile=profile, hits=hits)
+        script = ast.fix_missing_locations(addRules.visit(script))
+        script = ast.fix_missing_locations(RewriteRules().visit(script))
+
+        # 生成的数据不参与裁剪，只统计运行时部分的大小
+        runtime = lambda: len(
+            astor.to_source(
+                ast.Module([x for x in script.body if not addRules.isTable(x)], [])
+            )
+        )
+        if optimize:
+            before = runtime()
+            script = FoldConstants(addRules.tables).visit(script)
+            script = ShakeTree(addRules.linearTypes, addRules.constants).visit(script)
+            script = ast.fix_missing_locations(script)
+            after = runtime()
+
+            logging.info(f"runtime {before} -> {after} bytes")
+        source = astor.to_source(script)
+        # source += f"\n'''\n{astor.dump_tree(script)}\n'''\n"
+        return source
+
+    # 生成脚本，返回文件是否发生变化
+    def generate(self):
+        start = time.perf_counter()
+        source = Builder.render(self.profile, self.hits)
+        logging.info(
+            f"{self.rotateFileName} {len(source)} bytes"
+            f" ({time.perf_counter() - start:.2f} s)"
+        )
+
+        # 生成结果与当前文件一致时不做轮转，避免无意义的重载
+        if fileDigest(self.rotateFileName) == hashlib.sha256(source.encode()).digest():
+            logging.info(f"{self.rotateFileName} unchanged")
+            return False
+
+        with open(
+            fileRotate(self.rotateFileName, self.fileMaxRotate, self.compress),
+            "w",
+            encoding="utf-8",
+            newline="\n",
+        ) as stream:
+            stream.write(source)
+
+        return True
+
+    def reloadConfig(self):
+        # 重载配置
+        logging.info("reload configuration")
+        # 本地速度快不需要异步
+        # clash 本身就支持软链接，但必须是完整路径
+        start = time.perf_counter()
+        resp = controller().put(
+            f"http://{self.extCtrl}/configs?force=true",
+            json={"path": self.configPath},
+        )
+        logging.debug(f"reload {elapsed(start)} ms")
+        # 失败应当终止程序
+        assert resp.ok, f"{resp.text} {self.configPath}"
+
+    async def loop(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            await self.event.wait()
+            self.event.clear()
+
+            # 启动时等待所有订阅首次加载完成
+            if len(self.ready) < self.count:
+                continue
+
+            # 窗口期内没有新的更新才开始生成
+            while True:
+                try:
+                    await asyncio.wait_for(self.event.wait(), self.debounce)
+                except asyncio.TimeoutError:
+                    break
+                self.event.clear()
+
+            if self.build:
+                self.build = False
+                self.reload |= self.generate()
+            if not self.reload:
+                continue
+
+            # 限制重载频率，等待期间有新的更新时先合并再重载
+            if self.reloadTime is not None:
+                delay = self.reloadTime + self.reloadInterval - loop.time()
+                if delay > 0:
+                    logging.info(f"reload postponed {delay:.1f} s")
+                    await asyncio.sleep(delay)
+                    if self.event.is_set():
+                        continue
+
+            self.reload = False
+            self.reloadTime = loop.time()
+            self.reloadConfig()
+
+
+class Fetcher:
+    # 请求仍由 requests 完成，但只占用有限的线程，重试的等待也不再阻塞线程
+    def __init__(self, limit, timeout, retries=3, backoff=10):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(limit, "fetch")
+        self.semaphore = asyncio.Semaphore(limit)
+
+    async def get(self, url, headers=None):
+        url = urlunparse(url) if isinstance(url, tuple) and len(url) == 6 else url
+
+        for i in range(self.retries + 1):
+            try:
+                async with self.semaphore:
+                    # wait_for 无法中断线程，超时需同时交给 requests 才能释放线程
+                    return await asyncio.wait_for(
+                        asyncio.get_event_loop().run_in_executor(
+                            self.executor,
+                            functools.partial(
+                                get, url, headers=headers, timeout=self.timeout
+                            ),
+                        ),
+                        self.timeout,
+                    )
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+                asyncio.TimeoutError,
+            ) as e:
+                if i == self.retries:
+                    raise
+                delay = self.backoff * 2**i
+                logging.warning(f"{url} {e!r}, retry in {delay} s")
+                await asyncio.sleep(delay)
+
+
 class AddRules(ast.NodeTransformer):
     _Rules = []
+    _Same = {}  # push: url，使用 `same` 过滤的订阅
 
     @staticmethod
     def __toAstLiterals(data):
@@ -229,17 +579,364 @@ class AddRules(ast.NodeTransformer):
             vals.append(AddRules.__toAstLiterals(v))
         return ast.Dict(keys, vals)
 
+    @staticmethod
+    def __ruleKey(rule):
+        # 匹配条件、Policy 及 Option 都相同时，后面的规则命中的连接前者也会命中，
+        # 目标 IP 规则除外：解析域名后目标 IP 发生变化，见 __rules
+        # 不同 Policy 的规则在前者不可用时仍会命中，因此不视为相同
+        value = tuple(rule[2]) if isinstance(rule[2], list) else rule[2]
+        options = frozenset(x for x in rule[4].split(";") if x)
+        return rule[1], value, rule[3], options
+
     @classmethod
-    def __toAstRules(cls):
-        return cls.__toAstLiterals([y for x in cls._Rules if x for y in x])
+    def __rules(cls):
+        rules = []
+        seen = set()
+        resolved = False
+        for push, x in enumerate(cls._Rules):
+            dropped = 0
+            for rule in x or []:
+                # 与 __shadow 相同，解析域名前的目标 IP 规则不能代替之后的
+                if not resolved and "IP" in rule[1] and "no-resolve" not in rule[4]:
+                    resolved = True
+                    seen = {
+                        k for k in seen if k[0] not in ("IP-CIDR", "IP-CIDR6", "GEOIP")
+                    }
+
+                key = AddRules.__ruleKey(rule)
+                if push in cls._Same and key in seen:
+                    logging.debug(f"same rule {rule[0]}")
+                    dropped += 1
+                    continue
+                seen.add(key)
+                rules.append(rule)
+
+            if push in cls._Same:
+                logging.info(f"same {cls._Same[push]}: {dropped} rules dropped")
+        return rules
+
+    @staticmethod
+    def __ipNet(ipnet):
+        # IPNet => [network, mask, family]，与 Contains 一致：
+        # IPv4 及 IPv4-mapped 网络按 4 字节比较，其余按 16 字节
+        nn, m = networkNumberAndMask(ipnet)
+        # CIDRMask 中的 `~byte(...)` 会产生负数，需截断为单字节
+        mask = int.from_bytes(bytes(x & 0xFF for x in m), "big")
+        return [int.from_bytes(bytes(nn), "big") & mask, mask, len(nn)]
+
+    @staticmethod
+    def __foldCase(s):
+        # 与 scriptcat 中的 foldCase 一致，规则来自 YAML，总是合法的 UTF-8
+        return foldRunes(list(s.encode("utf-8")))
+
+    @staticmethod
+    def __ipInterval(ipnet):
+        network, mask, family = ipnet
+        return family, network, network | ~mask & ((1 << 8 * family) - 1)
+
+    @staticmethod
+    def __ipIndex(intervals):
+        # 将可能重叠的网段拆分为互不相交的区间，每个区间携带覆盖它的全部规则下标（升序）
+        events = {}
+        for lo, hi, i in intervals:
+            events.setdefault(lo, [[], []])[0].append(i)
+            events.setdefault(hi + 1, [[], []])[1].append(i)
+
+        table = {"Lo": [], "Hi": [], "Rules": []}
+        active = set()
+        points = sorted(events)
+        for j, x in enumerate(points):
+            active.difference_update(events[x][1])
+            active.update(events[x][0])
+            if not active or j + 1 == len(points):
+                continue
+            rules = sorted(active)
+            # 合并相邻且规则相同的区间
+            if (
+                table["Rules"]
+                and table["Rules"][-1] == rules
+                and table["Hi"][-1] + 1 == x
+            ):
+                table["Hi"][-1] = points[j + 1] - 1
+                continue
+            table["Lo"].append(x)
+            table["Hi"].append(points[j + 1] - 1)
+            table["Rules"].append(rules)
+        return table
+
+    @staticmethod
+    def __keywordIndex(keywords):
+        # Aho-Corasick 自动机，按字节构建以与 starlark-go 的字符串语义保持一致
+        table = {"Goto": [{}], "Fail": [0], "Rules": [[]]}
+        for k, i in keywords:
+            state = 0
+            for c in k.encode("utf-8"):
+                if c not in table["Goto"][state]:
+                    table["Goto"][state][c] = len(table["Goto"])
+                    table["Goto"].append({})
+                    table["Fail"].append(0)
+                    table["Rules"].append([])
+                state = table["Goto"][state][c]
+            table["Rules"][state].append(i)
+
+        # 广度优先计算失配指针，并将后缀状态的输出合并进来
+        queue = list(table["Goto"][0].values())
+        for state in queue:
+            for c, nxt in table["Goto"][state].items():
+                fail = table["Fail"][state]
+                while fail and c not in table["Goto"][fail]:
+                    fail = table["Fail"][fail]
+                fail = table["Goto"][fail].get(c, 0)
+                table["Fail"][nxt] = fail
+                table["Rules"][nxt] = sorted(table["Rules"][nxt] + table["Rules"][fail])
+                queue.append(nxt)
+        return table
+
+    @staticmethod
+    def __coverKeys(rule):
+        # 返回能够覆盖该规则的规则键，及该规则自身的键
+        t, v = rule[1], rule[2]
+        if t in ("DOMAIN", "DOMAIN-SUFFIX"):
+            labels = v.split(".")
+            keys = [("DOMAIN-SUFFIX", ".".join(labels[i:])) for i in range(len(labels))]
+            return keys + [(t, v)] if t == "DOMAIN" else keys, (t, v)
+        if "IP-CIDR" in t:
+            # 前缀更短且包含该网络的 CIDR
+            kind = "SRC" if t == "SRC-IP-CIDR" else "DST"
+            network, mask, family = v
+            bits = 8 * family
+            prefix = bin(mask).count("1")
+            keys = [(kind, family, p, network >> (bits - p)) for p in range(prefix + 1)]
+            return keys, keys[-1]
+        return [(t, v)], (t, v)
 
-    def __init__(self, insert):
+    @staticmethod
+    def __shadow(rules):
+        # 移除被之前的规则完全覆盖且结果（Policy 及 UDP）相同的规则，它们不可能最先命中
+        # 结果不同的规则在之前的节点不可用时仍会命中，只做报告
+        resolveAt = next(
+            (
+                i
+                for i, rule in enumerate(rules)
+                if "IP" in rule[1] and "no-resolve" not in rule[4]
+            ),
+            -1,
+        )
+
+        seen = {}  # key: {outcome: rule}
+        keywords = {}  # keyword: {outcome: rule}
+        match = {}  # outcome: rule
+        kept = []
+        removed = reported = 0
+        for i, rule in enumerate(rules):
+            # 解析域名后目标 IP 发生变化，之前的 IP 规则不再覆盖之后的
+            if i == resolveAt:
+                for k in [k for k in seen if k[0] in ("DST", "GEOIP")]:
+                    del seen[k]
+
+            keys, key = AddRules.__coverKeys(rule)
+            covers = [match, *[seen[k] for k in keys if k in seen]]
+            if rule[1] in ("DOMAIN", "DOMAIN-SUFFIX", "DOMAIN-KEYWORD"):
+                covers.extend(x for k, x in keywords.items() if k in rule[2])
+
+            outcome = (rule[3], "disable-udp" in rule[4])
+            # 首条需要解析域名的规则决定了解析的时机，始终保留
+            if i != resolveAt and any(outcome in x for x in covers):
+                cover = next(x[outcome] for x in covers if outcome in x)
+                logging.debug(f"shadowed {rule[0]} by {cover[0]}, removed")
+                removed += 1
+                continue
+
+            cover = next((x for x in covers if x), None)
+            if cover:
+                cover = next(iter(cover.values()))
+                logging.debug(f"shadowed {rule[0]} by {cover[0]}, different policy")
+                reported += 1
+
+            kept.append(rule)
+            if rule[1] == "MATCH":
+                match.setdefault(outcome, rule)
+            elif rule[1] == "DOMAIN-KEYWORD":
+                keywords.setdefault(rule[2], {}).setdefault(outcome, rule)
+            else:
+                seen.setdefault(key, {}).setdefault(outcome, rule)
+
+        logging.info(f"shadowed rules: {removed} removed, {reported} reported")
+        return kept
+
+    @staticmethod
+    def __overlaps(a, b):
+        # 是否存在同时命中两条规则的连接，无法确定时视为存在
+        if a[1] == "MATCH" or b[1] == "MATCH":
+            return True
+        host = ("DOMAIN", "DOMAIN-SUFFIX", "DOMAIN-KEYWORD")
+        if a[1] in host and b[1] in host:
+            if not a[2] or not b[2] or a[2][0] == "." or b[2][0] == ".":
+                return True
+            if a[1] == "DOMAIN-KEYWORD" or b[1] == "DOMAIN-KEYWORD":
+                k, v = (a, b) if a[1] == "DOMAIN-KEYWORD" else (b, a)
+                return v[1] != "DOMAIN" or k[2] in v[2]
+            if a[1] == "DOMAIN" and b[1] == "DOMAIN":
+                return a[2] == b[2]
+            # 与 ruleMatch 一致：host.endswith("." + Matcher) or Matcher == host
+            if a[1] == "DOMAIN" or b[1] == "DOMAIN":
+                d, x = (a, b) if a[1] == "DOMAIN" else (b, a)
+                return d[2] == x[2] or d[2].endswith("." + x[2])
+            x, y = sorted((a[2], b[2]), key=len)
+            return y == x or y.endswith("." + x)
+
+        kind = lambda x: "SRC" if x == "SRC-IP-CIDR" else "DST"
+        if "IP-CIDR" in a[1] and "IP-CIDR" in b[1] and kind(a[1]) == kind(b[1]):
+            x, y = AddRules.__ipInterval(a[2]), AddRules.__ipInterval(b[2])
+            return x[0] == y[0] and x[1] <= y[2] and y[1] <= x[2]
+
+        if a[1] != b[1]:
+            return True
+        if a[1] in ("DST-PORT", "SRC-PORT"):
+            return a[2] == b[2]
+        # Matcher 已经折叠；GEOIP,LAN 与国家代码可能同时命中
+        if a[1] in ("PROCESS-NAME", "PROCESS-PATH", "GEOIP"):
+            if a[1] == "GEOIP" and "LAN" in (a[2], b[2]):
+                return True
+            return a[2] == b[2]
+        return True
+
+    @staticmethod
+    def __reorder(rules, hits):
+        # 按命中次数将热点规则前移，只跨过与之不可能同时命中或结果相同的规则：
+        # 相邻两条规则交换后，任一连接依次命中的结果序列不变，节点不可用时的回退也不变。
+        # 首条需要解析域名的规则之后目标 IP 可能改变，因此规则不跨过它移动。
+        resolveAt = next(
+            (
+                i
+                for i, rule in enumerate(rules)
+                if "IP" in rule[1] and "no-resolve" not in rule[4]
+            ),
+            -1,
+        )
+        count = lambda rule: hits.get(rule[0], 0)
+        outcome = lambda rule: (rule[3], "disable-udp" in rule[4])
+
+        rules = list(rules)
+        position = {id(x): i for i, x in enumerate(rules)}
+        barrier = rules[resolveAt] if resolveAt >= 0 else None
+        hot = sorted(
+            (x for x in rules if count(x) and x is not barrier),
+            key=lambda x: (-count(x), position[id(x)]),
+        )
+
+        moved = 0
+        for rule in hot:
+            i = j = next(k for k, x in enumerate(rules) if x is rule)
+            start = (
+                position[id(barrier)] + 1
+                if barrier and i > position[id(barrier)]
+                else 0
+            )
+            disjoint = same = 0
+            reason = "block start"
+            while j > start:
+                prev = rules[j - 1]
+                if count(prev) >= count(rule):
+                    reason = f"hotter {prev[0]}"
+                    break
+                if outcome(prev) == outcome(rule):
+                    same += 1
+                elif not AddRules.__overlaps(prev, rule):
+                    disjoint += 1
+                else:
+                    reason = f"overlaps {prev[0]}"
+                    break
+                j -= 1
+
+            if j == i:
+                continue
+            rules.insert(j, rules.pop(i))
+            moved += 1
+            logging.info(
+                f"reorder {rule[0]} ({count(rule)} hits) {i} -> {j}: passed"
+                f" {disjoint} disjoint and {same} same-policy rules, stopped at {reason}"
+            )
+
+        logging.info(f"reordered rules: {moved} of {len(hot)} hot rules moved")
+        return rules
+
+    @staticmethod
+    def __indexes(rules):
+        # 按下标升序追加，列表首项即最先命中的规则，其余用于节点不可用时继续匹配
+        domain, suffix, keyword, linear = {}, {}, [], []
+        dst, src = {4: [], 16: []}, {4: [], 16: []}
+        dstPort, srcPort, process, processPath = {}, {}, {}, {}
+        resolveAt = processAt = dstAt = srcAt = geoipAt = -1
+        for i, rule in enumerate(rules):
+            # 首条需要解析域名的规则，与 shouldResolveIP 的静态部分一致
+            if resolveAt < 0 and "IP" in rule[1] and "no-resolve" not in rule[4]:
+                resolveAt = i
+            if processAt < 0 and "PROCESS" in rule[1]:
+                processAt = i
+            # 运行时按需解析 IP 及查询 GeoIP，shouldResolveIP 同样需要目标 IP
+            if dstAt < 0 and (
+                rule[1] in ("IP-CIDR", "IP-CIDR6", "GEOIP") or i == resolveAt
+            ):
+                dstAt = i
+            if srcAt < 0 and rule[1] == "SRC-IP-CIDR":
+                srcAt = i
+            if geoipAt < 0 and rule[1] == "GEOIP" and rule[2] != "LAN":
+                geoipAt = i
+
+            if rule[1] == "DOMAIN":
+                domain.setdefault(rule[2], []).append(i)
+            # 空值及以 `.` 开头的后缀无法通过标签拆分命中，仍交由 ruleMatch 处理
+            elif rule[1] == "DOMAIN-SUFFIX" and rule[2] and rule[2][0] != ".":
+                suffix.setdefault(rule[2], []).append(i)
+            elif rule[1] == "DOMAIN-KEYWORD" and rule[2]:
+                keyword.append((rule[2], i))
+            elif "IP-CIDR" in rule[1]:
+                family, lo, hi = AddRules.__ipInterval(rule[2])
+                (src if rule[1] == "SRC-IP-CIDR" else dst)[family].append((lo, hi, i))
+            elif rule[1] == "DST-PORT":
+                dstPort.setdefault(rule[2], []).append(i)
+            elif rule[1] == "SRC-PORT":
+                srcPort.setdefault(rule[2], []).append(i)
+            elif rule[1] == "PROCESS-NAME":
+                process.setdefault(rule[2], []).append(i)
+            elif rule[1] == "PROCESS-PATH":
+                processPath.setdefault(rule[2], []).append(i)
+            else:
+                linear.append(i)
+        return {
+            "_DOMAIN_INDEX": domain,
+            "_SUFFIX_INDEX": suffix,
+            "_KEYWORD_INDEX": AddRules.__keywordIndex(keyword),
+            "_IPV4_INDEX": AddRules.__ipIndex(dst[4]),
+            "_IPV6_INDEX": AddRules.__ipIndex(dst[16]),
+            "_SRC_IPV4_INDEX": AddRules.__ipIndex(src[4]),
+            "_SRC_IPV6_INDEX": AddRules.__ipIndex(src[16]),
+            "_DST_PORT_INDEX": dstPort,
+            "_SRC_PORT_INDEX": srcPort,
+            "_PROCESS_INDEX": process,
+            "_PROCESS_PATH_INDEX": processPath,
+            "_LINEAR_RULES": linear,
+            "_RESOLVE_AT": resolveAt,
+            "_PROCESS_AT": processAt,
+            "_DST_IP_AT": dstAt,
+            "_SRC_IP_AT": srcAt,
+            "_GEOIP_AT": geoipAt,
+        }
+
+    def __init__(self, insert=None, profile=0, hits=None):
         super().__init__()
+        self.profile = profile
+        self.hits = hits
+
+        # 仅用于生成
+        if insert is None:
+            return
 
         assert len(AddRules._Rules) > insert.push, "insufficient list space"
         self.filter = set(insert.filter)  # complexity -> Average: O(1), Worst: O(n)
 
-        data = yaml.load(insert.text, Loader=yaml.Loader)["rules"]
+        data = iterRules(insert.text)
 
         # 过滤规则
         if False:
@@ -249,17 +946,23 @@ class AddRules(ast.NodeTransformer):
         elif "all" in self.filter:
             data = []
         else:
-            # TODO: same
-            data = [
+            data = (
                 x
                 for x in data
                 if True
-                and ("geoip" in self.filter and "GEOIP" not in x)
-                and ("match" in self.filter and "MATCH" not in x)
-            ]
+                and ("geoip" not in self.filter or "GEOIP" not in x)
+                and ("match" not in self.filter or "MATCH" not in x)
+            )
+
+        # 与之前的规则重复时在生成阶段移除，见 __rules
+        if "same" in self.filter:
+            AddRules._Same[insert.push] = urlunparse(insert.url)
+        else:
+            AddRules._Same.pop(insert.push, None)
 
         # 解析规则
-        for i, e in enumerate(data):
+        rules = []
+        for e in data:
             rule = e.split(",")
             rule.insert(0, e)  # original_rule_string
 
@@ -269,7 +972,10 @@ class AddRules(ast.NodeTransformer):
                 if err:
                     logging.error(f"illegal IP {err['Text']}")
                     continue
-                rule[2] = ipnet
+                rule[2] = AddRules.__ipNet(ipnet)
+            # 大小写不敏感的 Matcher 保存为折叠后的形式，运行时只需比较字符串
+            elif rule[1] in ("GEOIP", "PROCESS-NAME", "PROCESS-PATH"):
+                rule[2] = AddRules.__foldCase(rule[2])
 
             j = 2 if rule[1] == "MATCH" else 3
             p = rule[j]
@@ -291,33 +997,484 @@ class AddRules(ast.NodeTransformer):
             elif len(rule) == 4:
                 rule.append("disable-udp" if insert.policies[p] else "")
 
-            data[i] = rule
+            rules.append(rule)
 
-        AddRules._Rules[insert.push] = data
+        AddRules._Rules[insert.push] = rules
 
     def visit_Module(self, node):
-        node.body.insert(
-            0, ast.Assign([ast.Name("_RULES", ast.Store)], AddRules.__toAstRules())
-        )
+        rules = AddRules.__shadow(AddRules.__rules())
+        if self.hits:
+            rules = AddRules.__reorder(rules, self.hits)
+        indexes = AddRules.__indexes(rules)
+        indexes["_PROFILE"] = self.profile
+
+        # 供 ShakeTree 使用：需要 ruleMatch 处理的规则类型及生成的常量
+        self.linearTypes = {rules[i][1] for i in indexes["_LINEAR_RULES"]}
+        self.constants = {k[1:]: v for k, v in indexes.items() if isinstance(v, int)}
+        self.tables = {"_RULES", *indexes}
+
+        node.body[:0] = [
+            ast.Assign(
+                [ast.Name("_RULES", ast.Store)], AddRules.__toAstLiterals(rules)
+            ),
+            *[
+                ast.Assign([ast.Name(k, ast.Store)], AddRules.__toAstLiterals(v))
+                for k, v in indexes.items()
+            ],
+        ]
         return node
 
+    def isTable(self, node):
+        return isinstance(node, ast.Assign) and any(
+            isinstance(x, ast.Name) and x.id in self.tables for x in node.targets
+        )
+
 
 class RewriteRules(ast.NodeTransformer):
+    # `NAME = _NAME = default` => `NAME = _NAME`，其中 `_NAME` 由 AddRules 生成
     def visit_Assign(self, node):
         if not (
             len(node.targets) == 2
             and isinstance(node.targets[0], ast.Name)
-            and node.targets[0].id == "RULES"
+            and isinstance(node.targets[1], ast.Name)
+            and node.targets[1].id == f"_{node.targets[0].id}"
         ):
             return node
+        node.targets[1].ctx = ast.Load()
         return ast.Assign(node.targets[:1], node.targets[1])
 
 
+# 在生成时完成 scriptcat 中可确定的计算，减少 starlark 在热点循环中的函数调用：
+#   1. 只赋值一次的顶层标量（如 utf8_RuneSelf、nil）在使用处替换为字面量
+#   2. 参数均为常量的 rune()、byte()、uint() 等整数包装及整数运算直接求值
+#   3. 参数取值范围已落在目标类型内时，去掉包装本身，如 rune(s0 & 0x1F)
+# tables 为 AddRules 生成的数据，体积庞大且不含可折叠的表达式，仅记录其中的标量。
+class FoldConstants(ast.NodeTransformer):
+    # name: (min, max)，与 scriptcat 中 int8 系列的定义一致
+    __types = {
+        "int8": (-(1 << 7), (1 << 7) - 1),
+        "int16": (-(1 << 15), (1 << 15) - 1),
+        "int32": (-(1 << 31), (1 << 31) - 1),
+        "int64": (-(1 << 63), (1 << 63) - 1),
+        "rune": (-(1 << 31), (1 << 31) - 1),
+        "uint8": (0, (1 << 8) - 1),
+        "uint16": (0, (1 << 16) - 1),
+        "uint32": (0, (1 << 32) - 1),
+        "uint64": (0, (1 << 64) - 1),
+        "byte": (0, (1 << 8) - 1),
+        "uint": (0, (1 << 64) - 1),
+    }
+
+    __binOps = {
+        ast.Add: lambda a, b: a + b,
+        ast.Sub: lambda a, b: a - b,
+        ast.Mult: lambda a, b: a * b,
+        ast.FloorDiv: lambda a, b: a // b,
+        ast.LShift: lambda a, b: a << b,
+        ast.RShift: lambda a, b: a >> b,
+        ast.BitAnd: lambda a, b: a & b,
+        ast.BitOr: lambda a, b: a | b,
+        ast.BitXor: lambda a, b: a ^ b,
+    }
+
+    __unaryOps = {
+        ast.USub: lambda a: -a,
+        ast.UAdd: lambda a: +a,
+        ast.Invert: lambda a: ~a,
+    }
+
+    def __init__(self, tables=()):
+        super().__init__()
+        self.tables = tables
+        self.constants = {}
+        self.shadow = set()
+
+    @staticmethod
+    def __convert(name, x):
+        # 等价于 scriptcat 中的 int8(x, maxint) 及 uint8(x, maxint)
+        lo, hi = FoldConstants.__types[name]
+        bits = (hi - lo).bit_length()
+        # 字符串只取码点的低位，不做符号扩展
+        if isinstance(x, str):
+            return ord(x) & (1 << bits) - 1
+        if not isinstance(x, int) or isinstance(x, bool):
+            raise TypeError(x)
+        x &= (1 << bits) - 1
+        return x - (1 << bits) if x > hi else x
+
+    @staticmethod
+    def __constant(node):
+        if isinstance(node, ast.Constant):
+            return True, node.value
+        if isinstance(node, (getattr(ast, "Num", ()), getattr(ast, "Str", ()))):
+            return True, ast.literal_eval(node)  # Python < 3.8
+        return False, None
+
+    @staticmethod
+    def __int(node):
+        ok, value = FoldConstants.__constant(node)
+        return ok and isinstance(value, int) and not isinstance(value, bool), value
+
+    def __range(self, node):
+        # 返回整数表达式的取值范围 (lo, hi)，无法确定时返回 None
+        ok, value = FoldConstants.__int(node)
+        if ok:
+            return value, value
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id in FoldConstants.__types
+            and node.func.id not in self.shadow
+            and len(node.args) == 1
+        ):
+            return FoldConstants.__types[node.func.id]
+        if not isinstance(node, ast.BinOp):
+            return None
+
+        left = self.__range(node.left)
+        right = self.__range(node.right)
+        if isinstance(node.op, ast.BitAnd):
+            masks = [x for x in (left, right) if x and x[0] >= 0]
+            return (0, min(x[1] for x in masks)) if masks else None
+        if left is None or left[0] < 0:
+            return None
+        if isinstance(node.op, ast.RShift):
+            # 移位数为负时 starlark 直接报错，因此结果不会大于左值
+            return (left[0] >> right[1], left[1] >> right[0]) if right else (0, left[1])
+        if right is None or right[0] < 0:
+            return None
+        if isinstance(node.op, ast.LShift):
+            return left[0] << right[0], left[1] << right[1]
+        if isinstance(node.op, (ast.BitOr, ast.BitXor)):
+            return 0, (1 << max(left[1], right[1]).bit_length()) - 1
+        if isinstance(node.op, ast.Add):
+            return left[0] + right[0], left[1] + right[1]
+        return None
+
+    @staticmethod
+    def __scalar(value):
+        return value is None or isinstance(value, (bool, int, str))
+
+    @staticmethod
+    def __locals(node):
+        names = {x.arg for x in ast.walk(node.args) if isinstance(x, ast.arg)}
+        for x in ast.walk(node):
+            if isinstance(x, ast.Name) and not isinstance(x.ctx, ast.Load):
+                names.add(x.id)
+        return names
+
+    def visit_Module(self, node):
+        counts = {}
+        for x in node.body:
+            for t in getattr(x, "targets", []):
+                if isinstance(t, ast.Name):
+                    counts[t.id] = counts.get(t.id, 0) + 1
+
+        # 先按顺序处理顶层赋值，再处理函数，此时所有顶层常量均已可见
+        for i, x in enumerate(node.body):
+            if not isinstance(x, ast.Assign) or isinstance(x.value, ast.Lambda):
+                continue
+            names = [t.id for t in x.targets if isinstance(t, ast.Name)]
+            if not any(n in self.tables for n in names):
+                x.value = self.visit(x.value)
+            ok, value = FoldConstants.__constant(x.value)
+            if ok and FoldConstants.__scalar(value) and len(names) == len(x.targets):
+                for n in names:
+                    if counts[n] == 1:
+                        self.constants[n] = value
+
+        for i, x in enumerate(node.body):
+            if isinstance(x, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                node.body[i] = self.visit(x)
+            elif isinstance(x, ast.Assign) and isinstance(x.value, ast.Lambda):
+                x.value = self.visit(x.value)
+        return node
+
+    def visit_FunctionDef(self, node):
+        shadow = self.shadow
+        self.shadow = shadow | FoldConstants.__locals(node)
+        self.generic_visit(node)
+        self.shadow = shadow
+        return node
+
+    visit_Lambda = visit_FunctionDef
+
+    def visit_Name(self, node):
+        if (
+            isinstance(node.ctx, ast.Load)
+            and node.id in self.constants
+            and node.id not in self.shadow
+        ):
+            return ast.copy_location(ast.Constant(self.constants[node.id]), node)
+        return node
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if not isinstance(node.func, ast.Name) or node.func.id in self.shadow:
+            return node
+        name = node.func.id
+
+        if name in FoldConstants.__types and len(node.args) == 1 and not node.keywords:
+            ok, value = FoldConstants.__constant(node.args[0])
+            if ok:
+                try:
+                    value = FoldConstants.__convert(name, value)
+                except (TypeError, ValueError):
+                    return node
+                return ast.copy_location(ast.Constant(value), node)
+            lo, hi = FoldConstants.__types[name]
+            r = self.__range(node.args[0])
+            if r and lo <= r[0] and r[1] <= hi:
+                return node.args[0]
+
+        # int() 作用于整数时不改变取值
+        if name == "int" and len(node.args) == 1 and self.__range(node.args[0]):
+            return node.args[0]
+        return node
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        op = FoldConstants.__binOps.get(type(node.op))
+        left, a = FoldConstants.__int(node.left)
+        right, b = FoldConstants.__int(node.right)
+        if op and left and right:
+            try:
+                return ast.copy_location(ast.Constant(op(a, b)), node)
+            except (ValueError, ZeroDivisionError):
+                pass
+        return node
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        op = FoldConstants.__unaryOps.get(type(node.op))
+        ok, value = FoldConstants.__int(node.operand)
+        if op and ok:
+            return ast.copy_location(ast.Constant(op(value)), node)
+        return node
+
+
+# 裁剪生成的脚本，以减小 clash 每次重载时解析的体积：
+#   1. 按 types（交由 ruleMatch 处理的规则类型）裁剪 ruleMatch 中不可能进入的分支
+#   2. 按 constants（AddRules 生成的整数常量）裁剪恒为真或恒为假的分支
+#   3. 移除函数的文档字符串，注释在 astor 输出时已被丢弃
+#   4. 仅保留从 main 可达的顶层定义
+class ShakeTree(ast.NodeTransformer):
+    __ops = {
+        ast.Eq: lambda a, b: a == b,
+        ast.NotEq: lambda a, b: a != b,
+        ast.Lt: lambda a, b: a < b,
+        ast.LtE: lambda a, b: a <= b,
+        ast.Gt: lambda a, b: a > b,
+        ast.GtE: lambda a, b: a >= b,
+        ast.In: lambda a, b: a in b,
+        ast.NotIn: lambda a, b: a not in b,
+    }
+
+    def __init__(self, types, constants, roots=("main",)):
+        super().__init__()
+        self.types = types
+        self.constants = constants
+        self.roots = roots
+        self.function = None
+
+    @staticmethod
+    def __targets(node):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            return {node.name}
+        if isinstance(node, ast.Assign):
+            return {x.id for x in node.targets if isinstance(x, ast.Name)}
+        return set()
+
+    @staticmethod
+    def __body(body):
+        return body or [ast.Pass()]
+
+    def __values(self, node):
+        # 返回表达式所有可能的取值，无法确定时返回 None
+        if (
+            self.function == "ruleMatch"
+            and isinstance(node, ast.Subscript)
+            and isinstance(node.value, ast.Name)
+            and node.value.id == "rule"
+        ):
+            index = node.slice
+            if isinstance(index, getattr(ast, "Index", ())):  # Python < 3.9
+                index = index.value
+            if self.__values(index) == [1]:
+                return list(self.types)
+        if isinstance(node, ast.Name) and node.id in self.constants:
+            return [self.constants[node.id]]
+        try:
+            return [ast.literal_eval(node)]
+        except (ValueError, TypeError, SyntaxError):
+            return None
+
+    def __evaluate(self, node):
+        # 返回 True / False，无法确定时返回 None
+        if isinstance(node, ast.BoolOp):
+            values = [self.__evaluate(x) for x in node.values]
+            short = isinstance(node.op, ast.Or)
+            if short in values:
+                return short
+            return None if None in values else not short
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            value = self.__evaluate(node.operand)
+            return None if value is None else not value
+        if isinstance(node, ast.Compare) and len(node.ops) == 1:
+            op = ShakeTree.__ops.get(type(node.ops[0]))
+            left = self.__values(node.left)
+            right = self.__values(node.comparators[0])
+            if op is None or left is None or right is None:
+                return None
+            values = {op(a, b) for a in left for b in right}
+            # 没有任何取值说明分支不可达
+            return values.pop() if len(values) == 1 else (False if not values else None)
+        return None
+
+    def visit_Module(self, node):
+        # 分支只存在于函数中，跳过体积庞大的规则数据
+        node.body = [
+            self.visit(x) if isinstance(x, ast.FunctionDef) else x for x in node.body
+        ]
+
+        defs = {}
+        for x in node.body:
+            for name in ShakeTree.__targets(x):
+                defs.setdefault(name, []).append(x)
+
+        reachable = set()
+        queue = list(self.roots)
+        for name in queue:
+            if name in reachable or name not in defs:
+                continue
+            reachable.add(name)
+            for x in defs[name]:
+                queue.extend(y.id for y in ast.walk(x) if isinstance(y, ast.Name))
+
+        node.body = [x for x in node.body if reachable & ShakeTree.__targets(x)]
+        return node
+
+    def visit_FunctionDef(self, node):
+        if ast.get_docstring(node, clean=False) is not None:
+            node.body = node.body[1:]
+        self.function = node.name
+        self.generic_visit(node)
+        self.function = None
+        node.body = ShakeTree.__body(node.body)
+        return node
+
+    def visit_For(self, node):
+        self.generic_visit(node)
+        node.body = ShakeTree.__body(node.body)
+        return node
+
+    def visit_If(self, node):
+        self.generic_visit(node)
+        value = self.__evaluate(node.test)
+        if value is False:
+            return node.orelse or None
+        if value is True:
+            return node.body
+        node.body = ShakeTree.__body(node.body)
+        return node
+
+
+# 汇总 --profile 脚本经 ctx.log 输出的采样记录，生成热点规则报告
+#
+# clash 日志中的记录形如（外层可能带有 logrus 的 msg="..." 及 [Script] 前缀）：
+#   [PROFILE] us=57 rules=3 | DOMAIN-SUFFIX=2 MATCH=1 | MATCH,G
+# 普通脚本每次命中输出的日志也会计入 replay，用于按命中次数重排规则：
+#   [TCP] type=HTTP host=a.com src=1.2.3.4:5 dst=:443 | DOMAIN,a.com,A
+class Profile:
+    __record = re.compile(
+        r"\[PROFILE\] us=(\d+) rules=(\d+) \| ([^|]*)\| ?(.*?)\"?\s*$"
+    )
+    __replay = re.compile(
+        r"\[(?:TCP|UDP)\] type=\S* host=\S* src=\S* dst=\S* \| (.*?)\"?\s*$"
+    )
+
+    def __init__(self):
+        self.latency = []
+        self.evaluated = []
+        self.types = {}  # TYPE => 比较次数
+        self.hits = {}  # original_rule_string => [命中次数, 总耗时]
+        self.replay = {}  # original_rule_string => 命中次数
+
+    def feed(self, line):
+        m = Profile.__replay.search(line)
+        if m:
+            self.replay[m[1]] = self.replay.get(m[1], 0) + 1
+            return True
+
+        m = Profile.__record.search(line)
+        if not m:
+            return False
+
+        us, n = int(m[1]), int(m[2])
+        self.latency.append(us)
+        self.evaluated.append(n)
+        for x in m[3].split():
+            k, _, v = x.rpartition("=")
+            self.types[k] = self.types.get(k, 0) + int(v)
+
+        hit = self.hits.setdefault(m[4] or "(DIRECT)", [0, 0])
+        hit[0] += 1
+        hit[1] += us
+        return True
+
+    # 日志完整时优先使用 replay，否则使用采样记录
+    def hitCounts(self):
+        return self.replay or {k: v[0] for k, v in self.hits.items()}
+
+    @staticmethod
+    def __summary(values):
+        values = sorted(values)
+        at = lambda p: values[min(len(values) - 1, int(len(values) * p))]
+        return (
+            f"mean {sum(values) / len(values):.1f}"
+            f"  p50 {at(0.5)}  p90 {at(0.9)}  p99 {at(0.99)}  max {values[-1]}"
+        )
+
+    def report(self, top=20):
+        count = len(self.latency)
+        if not count:
+            return (
+                f"{sum(self.replay.values())} matched connections,"
+                " no [PROFILE] records, was the script generated with --profile?"
+            )
+
+        out = [
+            f"{count} sampled connections",
+            f"latency (us)     {Profile.__summary(self.latency)}",
+            f"rules evaluated  {Profile.__summary(self.evaluated)}",
+            "",
+            f"{'type':<16} {'evaluated':>10} {'per conn':>9} {'share':>7}",
+        ]
+        total = sum(self.types.values()) or 1
+        for k, v in sorted(self.types.items(), key=lambda x: -x[1]):
+            out.append(f"{k:<16} {v:>10} {v / count:>9.2f} {v / total:>7.1%}")
+
+        out += ["", f"{'hits':>8} {'share':>7} {'mean us':>8}  rule"]
+        hits = sorted(self.hits.items(), key=lambda x: (-x[1][0], x[0]))
+        for k, (n, us) in hits[:top]:
+            out.append(f"{n:>8} {n / count:>7.1%} {us / n:>8.1f}  {k}")
+        return "\n".join(out)
+
+
 async def main():
     logging.basicConfig(level=logging.DEBUG)
 
     argv = argvparse()
-    aws = []
+    if argv.report:
+        profile = Profile()
+        for line in argv.report:
+            profile.feed(line)
+        print(profile.report())
+        return
+
+    BaseInsert._Fetcher = Fetcher(argv.fetch_limit, argv.fetch_timeout)
+    BaseInsert._Builder = Builder(argv)
+    aws = [BaseInsert._Builder.loop()]
     for i in argv.insert:
         aws.append(
             (FileInsert() if i.url.scheme == "file" else HTTPInsert()).loop(i, argv)
@@ -341,35 +1498,106 @@ class DictObj(dict):
     __setattr__ = dict.__setitem__
 
 
-def fileRotate(fileName, max):
+def fileRotate(fileName, max, compress=False):
+    suffix = ".gz" if compress else ""
     for i in range(max - 1 if max > 0 else 0, -1, -1):
-        newpath = Path(f"{fileName}.{i}")
-        oldpath = Path(f"{fileName}.{i-1}" if i else fileName)
+        newpath = Path(f"{fileName}.{i}{suffix}")
+        oldpath = Path(f"{fileName}.{i-1}{suffix}" if i else fileName)
         # remove the old file
         if newpath.exists() and newpath.is_file():
             os.remove(newpath)
         # change the new file to old file name
         if oldpath.exists() and oldpath.is_file():
-            os.rename(oldpath, newpath)
+            if compress and not i:
+                # 正在使用的文件保持原样，只压缩历史版本
+                newpath.write_bytes(gzip.compress(oldpath.read_bytes()))
+                os.remove(oldpath)
+            else:
+                os.rename(oldpath, newpath)
     return oldpath
 
 
+def openFile(fileName, mode, **kwargs):
+    # 以 .gz 结尾的文件透明地解压缩
+    if fileName.endswith(".gz"):
+        return gzip.open(fileName, mode if "b" in mode else f"{mode}t", **kwargs)
+    return open(fileName, mode, **kwargs)
+
+
+def fileDigest(fileName):
+    try:
+        with openFile(fileName, "rb") as stream:
+            return hashlib.sha256(stream.read()).digest()
+    except FileNotFoundError:
+        return None
+
+
 def abspath(path):
     path = os.path.abspath(path)
     # 软链接也可以是相对路径
     return abspath(os.readlink(path)) if os.path.islink(path) else path
 
 
-def get(url):
-    adapter = HTTPAdapter(max_retries=Retry(connect=3, backoff_factor=10))
+def rulesBlock(text):
+    # 返回顶层 `rules:` 部分的原文，无法定位时（如 flow 风格的顶层映射）返回 None
+    start = re.search(r"^rules[ \t]*:", text, re.M)
+    if not start:
+        return None
+
+    # 下一个顶层键或文档标记即为结尾，允许与 `rules:` 同列的 `- ` 序列
+    end = re.compile(r"^(?:[^\s#-]|-(?:\S|$))", re.M)
+    end = end.search(text, text.find("\n", start.end()) + 1 or len(text))
+    return text[start.start() : end.start() if end else len(text)]
+
+
+def iterRules(text):
+    # 只截取 `rules:` 部分逐条解析，跳过体积庞大的 proxies 及 proxy-groups
+    block = rulesBlock(text)
+    if block is None:
+        yield from yaml.load(text, Loader=SafeLoader)["rules"]
+        return
+
+    depth = 0
+    for event in yaml.parse(block, Loader=SafeLoader):
+        if isinstance(event, (yaml.SequenceStartEvent, yaml.MappingStartEvent)):
+            depth += 1
+        elif isinstance(event, (yaml.SequenceEndEvent, yaml.MappingEndEvent)):
+            depth -= 1
+        elif isinstance(event, yaml.ScalarEvent) and depth == 2:
+            yield event.value
+
+
+def elapsed(start):
+    return f"{(time.perf_counter() - start) * 1000:.1f}"
+
+
+# 整个进程共用一个连接池，订阅之间复用连接
+@functools.lru_cache(maxsize=None)
+def session():
+    # 重试由 Fetcher 负责
+    adapter = HTTPAdapter()
+
+    s = requests.Session()
+    # 声明所有可用的压缩格式（brotli、zstd 需安装对应的库）
+    s.headers["Accept-Encoding"] = ACCEPT_ENCODING
+    s.mount("file://", FileAdapter())
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
 
-    with requests.Session() as s:
-        s.mount("file://", FileAdapter())
-        s.mount("http://", adapter)
-        s.mount("https://", adapter)
-        return s.get(
-            urlunparse(url) if isinstance(url, tuple) and len(url) == 6 else url
-        )
+
+# external-controller 使用独立的长连接
+@functools.lru_cache(maxsize=None)
+def controller():
+    return requests.Session()
+
+
+def get(url, headers=None, timeout=None):
+    return session().get(
+        urlunparse(url) if isinstance(url, tuple) and len(url) == 6 else url,
+        headers=headers,
+        timeout=timeout,
+    )
 
 
 def argvparse():
@@ -398,13 +1626,13 @@ Clash subscription updater, supports the separation of rules and configuration f
     )
     parser.add_argument(
         "default_policy",
+        nargs="?",
         help="The clashdog checks for the existence of rule-policies in config.yaml and uses default_policy when they do not exist.",
     )
     parser.add_argument(
         "-i",
         "--insert",
         action="append",
-        required=True,
         help="merge rules in order",
         metavar="<Syntax>",
     )
@@ -438,6 +1666,68 @@ Clash subscription updater, supports the separation of rules and configuration f
         help="clash configuration file",
         metavar="config.yaml",
     )
+    parser.add_argument(
+        "-z",
+        "--compress",
+        action="append",
+        default=[],
+        choices=["history", "cache"],
+        help="gzip the rotated scripts and/or the saved subscriptions",
+    )
+    parser.add_argument(
+        "--debounce",
+        default=2,
+        type=float,
+        help="seconds without updates before the script is generated",
+        metavar=2,
+    )
+    parser.add_argument(
+        "--reload-interval",
+        default=10,
+        type=float,
+        help="minimum seconds between two configuration reloads",
+        metavar=10,
+    )
+    parser.add_argument(
+        "--quiet-period",
+        default=1,
+        type=float,
+        help="seconds a local file must stay unchanged before it is reloaded",
+        metavar=1,
+    )
+    parser.add_argument(
+        "--fetch-limit",
+        default=4,
+        type=int,
+        help="max concurrent subscription requests",
+        metavar=4,
+    )
+    parser.add_argument(
+        "--fetch-timeout",
+        default=60,
+        type=float,
+        help="deadline in seconds for each subscription request",
+        metavar=60,
+    )
+    parser.add_argument(
+        "--profile",
+        default=0,
+        type=int,
+        help="instrument the script and log one in N connections (by source port) for --report",
+        metavar=100,
+    )
+    parser.add_argument(
+        "--reorder",
+        type=argparse.FileType("r", encoding="utf-8", errors="replace"),
+        help="move frequently hit rules forward where it cannot change any match, by hits in a clash log",
+        metavar="clash.log",
+    )
+    parser.add_argument(
+        "--report",
+        type=argparse.FileType("r", encoding="utf-8", errors="replace"),
+        help="print a hot-rule report from the clash log of a --profile script and exit",
+        metavar="clash.log",
+    )
     parser.add_argument(
         "-v", "--version", action="version", version="1.0.7-alpha+20221206"
     )
@@ -445,6 +1735,12 @@ Clash subscription updater, supports the separation of rules and configuration f
     args = parser.parse_args()
     logging.debug(args)
 
+    # 生成报告时不需要订阅
+    if args.report is None and (args.default_policy is None or not args.insert):
+        parser.error(
+            "the following arguments are required: default_policy, -i/--insert"
+        )
+
     # 处理子参数
     if args.insert:
         parser = argparse.ArgumentParser(
@@ -10,11 +10,11 @@ nil = None
 def int8(x, maxint=0x7F):
     signbit = maxint + 1
 
-    if "string" in type(x):
+    if type(x) == type(""):
         # (maxint << 1) + 1 == maxint * 2 + 1 == maxint + (maxint + 1)
         return ord(x) & maxint + signbit
 
-    if not -signbit <= x <= maxint:
+    if not (-signbit <= x and x <= maxint):
         x = (x + signbit) % (2 * signbit) - signbit
     return x
 
@@ -51,7 +51,7 @@ codepoints = lambda s: list(s.codepoints())
 # 在starlark-go中，string由bytes实现，因此len在处理string时会引发歧义。
 # 建议替换所有len，当需要bytes时推荐使用string.elem_ords
 def slen(s):
-    if "string" in type(s):
+    if type(s) == type(""):
         return len(codepoints(s))
     return len(s)
 
@@ -66,6 +66,7 @@ def slen(s):
 # Numbers fundamental to the encoding.
 utf8_RuneError = rune('\uFFFD')  # the "error" Rune or "Unicode replacement character"
 utf8_RuneSelf = 0x80  # characters below RuneSelf are represented as themselves in a single byte. fmt: skip
+utf8_UTFMax = 4  # maximum number of bytes of a UTF-8 encoded Unicode character.
 
 utf8_maskx = 0b00111111
 utf8_mask2 = 0b00011111
@@ -147,8 +148,12 @@ utf8_acceptRanges = [
 # out of range, or is not the shortest possible UTF-8 encoding for the
 # value. No other validation is performed.
 def utf8_DecodeRuneInString(s):
-    s = elem_ords(s)
+    return utf8_DecodeRune(elem_ords(s))
+
 
+# DecodeRune unpacks the first UTF-8 encoding in p and returns the rune and
+# its width in bytes. p is a list of bytes, as returned by elem_ords.
+def utf8_DecodeRune(s):
     n = len(s)
     if n < 1:
         return utf8_RuneError, 0
@@ -231,7 +236,7 @@ def unicode_to(_case, r, caseRange):
     for _ in InfiniteLoop:
         if not lo < hi:
             break
-        m = lo + (hi - lo) / 2
+        m = lo + (hi - lo) // 2
         cr = caseRange[m]
         if rune(cr["Lo"]) <= r and r <= rune(cr["Hi"]):
             delta = cr["Delta"][_case]
@@ -320,8 +325,8 @@ def unicode_SimpleFold(r):
     for _ in InfiniteLoop:
         if not lo < hi:
             break
-        m = lo + (hi - lo) / 2
-        if rune(unicode_caseOrbit[m]["From"] < r):
+        m = lo + (hi - lo) // 2
+        if rune(unicode_caseOrbit[m]["From"]) < r:
             lo = m + 1
         else:
             hi = m
@@ -822,7 +827,13 @@ def strings_EqualFold(s, t):
 
 
 def strings_EqualFold_hasUnicode(s, t):
-    for _, sr in enumerate(s):
+    # s 与 t 均为 bytes，按 rune 遍历 s，相当于 `for _, sr := range s`
+    for _ in InfiniteLoop:
+        if len(s) == 0:
+            break
+        sr, size = utf8_DecodeRune(s)
+        s = s[size:]
+
         # If t is exhausted the strings are not equal.
         if len(t) == 0:
             return False
@@ -831,7 +842,7 @@ def strings_EqualFold_hasUnicode(s, t):
         if t[0] < utf8_RuneSelf:
             tr, t = rune(t[0]), t[1:]
         else:
-            r, size = utf8_DecodeRuneInString(t)
+            r, size = utf8_DecodeRune(t)
             tr, t = r, t[size:]
 
         # If they match, keep going; if not, return false.
@@ -865,6 +876,44 @@ def strings_EqualFold_hasUnicode(s, t):
     return len(t) == 0
 
 
+EqualFold = strings_EqualFold
+
+
+# 返回 s 在简单大小写折叠下的规范形式，EqualFold(s, t) 等价于 foldCase(s) == foldCase(t)
+#
+# 每个 rune 替换为其 SimpleFold 等价类中最小的码点，无效的 UTF-8 字节与 EqualFold
+# 一样视为 RuneError。ASCII 字母的等价类中最小的是大写字母（k、s 的等价类另含
+# K (U+212A)、ſ (U+017F)，均大于 ASCII），因此纯 ASCII 时结果即 upper()。
+def foldCase(s):
+    b = elem_ords(s)
+    for c in b:
+        if c >= utf8_RuneSelf:
+            return foldRunes(b)
+    return s.upper()
+
+
+# b 为 bytes，如 elem_ords 的结果
+def foldRunes(b):
+    out = []
+    i = 0
+    for _ in InfiniteLoop:
+        if not i < len(b):
+            break
+        r, size = utf8_DecodeRune(b[i : i + utf8_UTFMax])
+        i += size
+
+        m = r
+        f = unicode_SimpleFold(r)
+        for _ in InfiniteLoop:
+            if f == r:
+                break
+            if f < m:
+                m = f
+            f = unicode_SimpleFold(f)
+        out.append(chr(m))
+    return "".join(out)
+
+
 ###############################################################
 # See: https://github.com/golang/go/blob/master/src/os/path_windows.go
 ###############################################################
@@ -1363,13 +1412,90 @@ def ParseCIDR(s):
     return ip, {"IP": Mask(m, ip), "Mask": m}, nil
 
 
+###############################################################
+# 整数形式的 IP 地址
+#
+# 上面基于字节列表的函数仅为兼容保留，匹配时统一使用整数形式，
+# 避免每次连接都分配多个 16 字节的列表并逐字节比较：
+#
+#   IP    = [value, family]
+#   IPNet = [network, mask, family]
+#
+# family 为 IPv4len 或 IPv6len，与 Contains 一致，IPv4-mapped 地址按 IPv4 处理。
+###############################################################
+# ipInt converts the IP address ip (a byte list) to the integer form.
+def ipInt(ip):
+    if ip == nil:
+        return nil
+    x = To4(ip)
+    if x == nil:
+        x = ip
+    n = 0
+    for b in x:
+        n = n << 8 | b
+    return [n, len(x)]
+
+
+# Parse IPv4 address (d.d.d.d) directly into an integer.
+def parseIPv4Int(s):
+    n = 0
+    for i in range(IPv4len):
+        if len(s) == 0:
+            # Missing octets.
+            return nil
+        if i > 0:
+            if s[0] != ".":
+                return nil
+            s = s[1:]
+        d, c, ok = dtoi(s)
+        if not ok or d > 0xFF:
+            return nil
+        if c > 1 and s[0] == "0":
+            # Reject non-zero components with leading zeroes.
+            return nil
+        s = s[c:]
+        n = n << 8 | d
+    if len(s) != 0:
+        return nil
+    return n
+
+
+# ParseIPInt is like ParseIP but returns the integer form.
+def ParseIPInt(s):
+    for i in range(len(s)):
+        if False:
+            pass
+        elif "." == s[i]:
+            n = parseIPv4Int(s)
+            return nil if n == nil else [n, IPv4len]
+        elif ":" == s[i]:
+            return ipInt(parseIPv6(s))
+    return nil
+
+
+# ContainsInt reports whether the network n includes ip, both in integer form.
+def ContainsInt(ip, n):
+    return ip[1] == n[2] and ip[0] & n[1] == n[0]
+
+
+# IsPrivateInt is like IsPrivate but takes the integer form.
+def IsPrivateInt(ip):
+    if ip[1] == IPv4len:
+        return (
+            ip[0] >> 24 == 10  # 10/8
+            or ip[0] >> 20 == 0xAC1  # 172.16/12
+            or ip[0] >> 16 == 0xC0A8  # 192.168/16
+        )
+    return ip[0] >> 121 == 0x7E  # FC00::/7
+
+
 ###############################################################
 # 规则匹配区
 #
 # rule = [
 #   "original_rule_string",
 #   "Type",
-#   IPNet if "IP-CIDR" in rule[1] else "Matcher",
+#   [network, mask, family] if "IP-CIDR" in rule[1] else "Matcher",
 #   "Policy",
 #   "Option"
 # ]
@@ -1378,8 +1504,133 @@ def ParseCIDR(s):
 # 由于配置文件是静态的，外加脚本缺少相关接口，因此无法考虑 UDP 传递问题。
 # 无论是 Proxies 的 udp 还是 Proxy Groups 的 disable-udp 它们的默认值都是 false。
 # rule[4] = "no-resolve;disable-udp"
+#
+# 索引由 clashdog 生成，值为按升序排列的 RULES 下标，首项即最先命中的规则：
+#   DOMAIN_INDEX    = {"Matcher": [index, ...]}  DOMAIN
+#   SUFFIX_INDEX    = {"Matcher": [index, ...]}  DOMAIN-SUFFIX
+#   KEYWORD_INDEX   = {"Goto": [{byte: state}, ...], "Fail": [state, ...], "Rules": [[index, ...], ...]}
+#                                                DOMAIN-KEYWORD，Aho-Corasick 自动机，0 为初始状态
+#   IPV4_INDEX      = {"Lo": [int, ...], "Hi": [int, ...], "Rules": [[index, ...], ...]}
+#   IPV6_INDEX      = 同上                        IP-CIDR, IP-CIDR6
+#   SRC_IPV4_INDEX  = 同上
+#   SRC_IPV6_INDEX  = 同上                        SRC-IP-CIDR
+#   DST_PORT_INDEX  = {"Matcher": [index, ...]}  DST-PORT
+#   SRC_PORT_INDEX  = {"Matcher": [index, ...]}  SRC-PORT
+#   PROCESS_INDEX   = {"MATCHER": [index, ...]}  PROCESS-NAME
+#   PROCESS_PATH_INDEX = 同上                    PROCESS-PATH，键均为 foldCase 的结果
+#   LINEAR_RULES    = [index, ...]               未被索引的规则，逐条调用 ruleMatch
+#   RESOLVE_AT      = index                      首条可能触发域名解析的规则，-1 表示没有
+#   PROCESS_AT      = index                      首条 PROCESS 规则，-1 表示没有
+#   DST_IP_AT       = index                      首条读取目标 IP 的规则（含 RESOLVE_AT），-1 表示没有
+#   SRC_IP_AT       = index                      首条 SRC-IP-CIDR 规则，-1 表示没有
+#   GEOIP_AT        = index                      首条需要 IsoCode 的 GEOIP 规则，-1 表示没有
+#   PROFILE         = n                          --profile 的采样间隔，0 表示不采样
+#
+# IP 索引中的区间按 Lo 升序排列且互不相交，Rules 为覆盖该区间的全部规则。
 ###############################################################
 RULES = _RULES = []
+DOMAIN_INDEX = _DOMAIN_INDEX = {}
+SUFFIX_INDEX = _SUFFIX_INDEX = {}
+KEYWORD_INDEX = _KEYWORD_INDEX = {"Goto": [{}], "Fail": [0], "Rules": [[]]}
+IPV4_INDEX = _IPV4_INDEX = {"Lo": [], "Hi": [], "Rules": []}
+IPV6_INDEX = _IPV6_INDEX = {"Lo": [], "Hi": [], "Rules": []}
+SRC_IPV4_INDEX = _SRC_IPV4_INDEX = {"Lo": [], "Hi": [], "Rules": []}
+SRC_IPV6_INDEX = _SRC_IPV6_INDEX = {"Lo": [], "Hi": [], "Rules": []}
+DST_PORT_INDEX = _DST_PORT_INDEX = {}
+SRC_PORT_INDEX = _SRC_PORT_INDEX = {}
+PROCESS_INDEX = _PROCESS_INDEX = {}
+PROCESS_PATH_INDEX = _PROCESS_PATH_INDEX = {}
+LINEAR_RULES = _LINEAR_RULES = []
+RESOLVE_AT = _RESOLVE_AT = -1
+PROCESS_AT = _PROCESS_AT = -1
+DST_IP_AT = _DST_IP_AT = -1
+SRC_IP_AT = _SRC_IP_AT = -1
+GEOIP_AT = _GEOIP_AT = -1
+PROFILE = _PROFILE = 0
+
+
+# 返回命中 host 的 DOMAIN / DOMAIN-SUFFIX 规则下标
+#
+# 例如 "a.b.c" 依次查找后缀 "a.b.c"、"b.c"、"c"，等价于
+# host.endswith("." + Matcher) or Matcher == host
+def domainIndex(host):
+    out = list(DOMAIN_INDEX.get(host, []))
+    labels = host.split(".")
+    for i in range(len(labels)):
+        out.extend(SUFFIX_INDEX.get(".".join(labels[i:]), []))
+    return out
+
+
+# 返回 host 中出现的 DOMAIN-KEYWORD 规则下标，只需扫描一遍 host
+def keywordIndex(host):
+    goto = KEYWORD_INDEX["Goto"]
+    fail = KEYWORD_INDEX["Fail"]
+    if len(goto) == 1:
+        return []
+
+    found = {}
+    state = 0
+    for c in elem_ords(host):
+        for _ in InfiniteLoop:
+            if state == 0 or c in goto[state]:
+                break
+            state = fail[state]
+        state = goto[state].get(c, 0)
+        for i in KEYWORD_INDEX["Rules"][state]:
+            found[i] = True
+    return list(found)
+
+
+# 返回包含 ip 的 IP-CIDR 规则下标，ip 为 ParseIPInt 的结果
+def ipIndex(ip, v4, v6):
+    if ip == nil:
+        return []
+    table = v4 if ip[1] == IPv4len else v6
+    n = ip[0]
+
+    # binary search over intervals: the last one with Lo <= n
+    lo = 0
+    hi = len(table["Lo"])
+    for _ in InfiniteLoop:
+        if not lo < hi:
+            break
+        m = lo + (hi - lo) // 2
+        if table["Lo"][m] <= n:
+            lo = m + 1
+        else:
+            hi = m
+    if lo > 0 and n <= table["Hi"][lo - 1]:
+        return table["Rules"][lo - 1]
+    return []
+
+
+def dstIPIndex(metadata):
+    return ipIndex(metadata["dst_ipp"], IPV4_INDEX, IPV6_INDEX)
+
+
+def srcIPIndex(metadata):
+    return ipIndex(metadata["src_ipp"], SRC_IPV4_INDEX, SRC_IPV6_INDEX)
+
+
+# 返回无需解析 IP 即可查找的索引中命中的规则下标（升序），IP 索引由 match 按需合并
+def ruleIndex(metadata):
+    out = domainIndex(metadata["host"])
+    out.extend(keywordIndex(metadata["host"]))
+    out.extend(DST_PORT_INDEX.get(metadata["dst_port"], []))
+    out.extend(SRC_PORT_INDEX.get(metadata["src_port"], []))
+    return sorted(out)
+
+
+# 返回命中 ProcessName 及 ProcessPath 的 PROCESS 规则下标
+#
+# 规则中的 Matcher 在生成时已经折叠，EqualFold 简化为对连接一侧折叠一次后查找。
+def processIndex(metadata):
+    out = []
+    if PROCESS_INDEX:
+        out.extend(PROCESS_INDEX.get(foldCase(Base(metadata["ProcessPath"])), []))
+    if PROCESS_PATH_INDEX:
+        out.extend(PROCESS_PATH_INDEX.get(foldCase(metadata["ProcessPath"]), []))
+    return out
 
 
 def ruleMatch(metadata, rule):
@@ -1392,40 +1643,44 @@ def ruleMatch(metadata, rule):
 
     if "IP-CIDR" in rule[1]:
         ip = metadata["src_ipp"] if rule[1] == "SRC-IP-CIDR" else metadata["dst_ipp"]
-        return ip != nil and Contains(ip, rule[2])
+        return ip != nil and ContainsInt(ip, rule[2])
 
     if rule[1] == "GEOIP":
         ip = metadata["dst_ipp"]
         if ip == nil:
             return False
 
-        if EqualFold(rule[2], "LAN"):
-            return IsPrivate(ip)
-        return EqualFold(metadata["IsoCode"], rule[2])
+        # Matcher 在生成时已经折叠，IsoCode 由 setIsoCode 折叠
+        if rule[2] == "LAN":
+            return IsPrivateInt(ip)
+        return metadata["IsoCode"] == rule[2]
 
-    if rule[1] == "SRT-PORT":
+    if rule[1] == "SRC-PORT":
         return metadata["src_port"] == rule[2]
     if rule[1] == "DST-PORT":
         return metadata["dst_port"] == rule[2]
 
-    if rule[1] == "PROCESS-NAME":
-        return EqualFold(metadata["ProcessName"], rule[2])
-    if rule[1] == "PROCESS-PATH":
-        return EqualFold(metadata["ProcessPath"], rule[2])
-
     return rule[1] == "MATCH"
 
 
-# return: Proxy
-def ruleAdapter(proxies, rule):
-    proxy = proxies[rule[2] if rule[1] == "MATCH" else rule[3]]
-    proxy["ProxyAdapter"]["SupportUDP"] = "disable-udp" not in rule[4]
-    return proxy
+# 仅在规则命中后查找对应的节点，找不到时返回 nil
+# return: {"Name": "Policy", "Alive": bool, "Delay": int, "SupportUDP": bool}
+def ruleAdapter(ctx, rule):
+    name = rule[2] if rule[1] == "MATCH" else rule[3]
+    for p in ctx.proxy_providers["default"]:
+        if p.name == name:
+            return {
+                "Name": p.name,
+                "Alive": p.alive,
+                "Delay": p.delay,
+                "SupportUDP": "disable-udp" not in rule[4],
+            }
+    return nil
 
 
 def setMetadata(ctx, metadata, k, v=nil, *args, **kwargs):
     if "function" in type(v):  # 也可能是 builtin_function_or_method
-        args = [metadata[x] if x in metadata else x for x in args] if args else metadata
+        args = [metadata[x] if x in metadata else x for x in args] if args else [metadata]
         v = v(*args, **kwargs)
 
     if v != nil:
@@ -1435,13 +1690,17 @@ def setMetadata(ctx, metadata, k, v=nil, *args, **kwargs):
 
     if False:
         pass
-    elif k == "ProcessPath":
-        metadata["ProcessName"] = Base(v)
     elif k == "src_ip":
-        metadata["src_ipp"] = ParseIP(v)
+        metadata["src_ipp"] = ParseIPInt(v)
     elif k == "dst_ip":
-        metadata["dst_ipp"] = ParseIP(v)
-        metadata["IsoCode"] = ctx.geoip(v)
+        metadata["dst_ipp"] = ParseIPInt(v)
+
+
+# GEOIP 的 Matcher 在生成时已经折叠，IsoCode 在此折叠一次。
+# 只在 GEOIP_AT >= 0 的分支中调用，没有 GEOIP 规则时 unicode 折叠表不会被保留
+def setIsoCode(ctx, metadata):
+    setMetadata(ctx, metadata, "IsoCode", ctx.geoip, "dst_ip")
+    metadata["IsoCode"] = foldCase(metadata["IsoCode"])
 
 
 def shouldResolveIP(metadata, rule):
@@ -1458,44 +1717,135 @@ def shouldResolveIP(metadata, rule):
 #
 # See: https://github.com/Dreamacro/clash/blob/master/tunnel/tunnel.go
 def match(ctx, metadata):
-    proxies = {
-        p.name: {
-            "ProxyAdapter": {"Name": p.name},
-            "history": {"Time": time.now(), "Delay": p.delay},
-            "alive": p.alive,
-        }
-        for p in ctx.proxy_providers["default"]
-    }
-    setMetadata(ctx, metadata, "dst_ip")
-    setMetadata(ctx, metadata, "src_ip")
+    # 等价于 EqualFold(metadata["network"], "udp")：u、d、p 没有 ASCII 以外的折叠对象，
+    # 只比较 ASCII 小写即可，不会使 unicode 折叠表从 main 可达
+    udp = metadata["network"].lower() == "udp"
 
+    dstFound = False
+    srcFound = False
+    geoipFound = False
     resolved = False
     processFound = False
 
-    for rule in RULES:
-        if not resolved and shouldResolveIP(metadata, rule):
-            setMetadata(ctx, metadata, "dst_ip", ctx.resolve_ip, "host")
-            resolved = True
+    # 按下标顺序合并索引命中的规则与 LINEAR_RULES，保持与逐条匹配相同的先后次序
+    hits = ruleIndex(metadata)
+    h = 0
+    l = 0
+    for _ in InfiniteLoop:
+        i = hits[h] if h < len(hits) else len(RULES)
+        k = LINEAR_RULES[l] if l < len(LINEAR_RULES) else len(RULES)
+
+        # 以下步骤按所在位置的先后进行，一次越过多个位置时先进行最靠前的，
+        # 它合并的规则命中后便无需进行之后的步骤；位置相同时按代码顺序进行
+        at = min(i, k)
+        if not dstFound and DST_IP_AT >= 0 and DST_IP_AT < at:
+            at = DST_IP_AT
+        if not srcFound and SRC_IP_AT >= 0 and SRC_IP_AT < at:
+            at = SRC_IP_AT
+        if not geoipFound and GEOIP_AT >= 0 and GEOIP_AT < at:
+            at = GEOIP_AT
+        if not processFound and PROCESS_AT >= 0 and PROCESS_AT < at:
+            at = PROCESS_AT
+        if not resolved and RESOLVE_AT >= 0 and RESOLVE_AT < at:
+            at = RESOLVE_AT
+
+        # IP 在遇到首条读取它的规则时才解析，由域名等规则命中的连接无需解析及查询 GeoIP
+        if not dstFound and DST_IP_AT >= 0 and at >= DST_IP_AT:
+            dstFound = True
+            setMetadata(ctx, metadata, "dst_ip")
+            hits = sorted(hits[h:] + dstIPIndex(metadata))
+            h = 0
+            continue
+
+        if not srcFound and SRC_IP_AT >= 0 and at >= SRC_IP_AT:
+            srcFound = True
+            setMetadata(ctx, metadata, "src_ip")
+            hits = sorted(hits[h:] + srcIPIndex(metadata))
+            h = 0
+            continue
 
-        if not processFound and "PROCESS" in rule[1]:
+        if not geoipFound and GEOIP_AT >= 0 and at >= GEOIP_AT:
+            geoipFound = True
+            if metadata["dst_ipp"] != nil:
+                setIsoCode(ctx, metadata)
+            continue
+
+        # 同理，进程信息在遇到首条 PROCESS 规则时才获取
+        if not processFound and PROCESS_AT >= 0 and at >= PROCESS_AT:
             processFound = True
             setMetadata(ctx, metadata, "ProcessPath", ctx.resolve_process_name)
+            hits = sorted(hits[h:] + processIndex(metadata))
+            h = 0
+            continue
 
-        if ruleMatch(metadata, rule):
-            adapter, ok, _ = ruleAdapter(proxies, rule).values()
-            if not ok:
+        # 逐条匹配时会在 RESOLVE_AT 处解析域名，之后的 IP 规则使用解析结果
+        if not resolved and RESOLVE_AT >= 0 and at >= RESOLVE_AT:
+            resolved = True
+            if shouldResolveIP(metadata, RULES[RESOLVE_AT]):
+                setMetadata(ctx, metadata, "dst_ip", ctx.resolve_ip, "host")
+                if GEOIP_AT >= 0 and geoipFound and metadata["dst_ipp"] != nil:
+                    setIsoCode(ctx, metadata)
+                ips = [x for x in dstIPIndex(metadata) if x >= RESOLVE_AT]
+                hits = sorted(hits[h:] + ips)
+                h = 0
+            continue
+
+        if i < k:
+            rule = RULES[i]
+            h += 1
+            hit = True
+        elif k < i:
+            rule = RULES[k]
+            l += 1
+            hit = False
+        else:
+            break
+
+        if PROFILE > 0 and "Evaluated" in metadata:
+            evaluated = metadata["Evaluated"]
+            evaluated[rule[1]] = evaluated.get(rule[1], 0) + 1
+
+        if hit or ruleMatch(metadata, rule):
+            adapter = ruleAdapter(ctx, rule)
+            if adapter == nil or not adapter["Alive"]:
                 continue
-            if EqualFold(metadata["network"], "udp") and not adapter["SupportUDP"]:
+            if udp and not adapter["SupportUDP"]:
                 continue
             return adapter["Name"], rule[0]
 
     return "DIRECT", nil
 
 
+# 记录一次匹配中各类型规则的比较次数及耗时，由 clashdog --report 汇总
+#
+# starlark 的全局变量在加载后冻结，无法跨连接累计，因此只按源端口采样输出单条记录：
+#   [PROFILE] us=耗时 rules=比较次数 | TYPE=次数 ... | original_rule_string
+def profile(ctx, metadata):
+    metadata["Evaluated"] = {}
+    start = time.now()
+    _, rule = match(ctx, metadata)
+    us = int((time.now() - start) // time.microsecond)
+
+    total = 0
+    out = []
+    for k, v in metadata["Evaluated"].items():
+        total += v
+        out.append("{0}={1}".format(k, v))
+    ctx.log(
+        "[PROFILE] us={0} rules={1} | {2} | {3}".format(
+            us, total, " ".join(out), rule if rule != nil else ""
+        )
+    )
+    return _, rule
+
+
 # See: https://github.com/Dreamacro/clash/wiki/Premium:-Scripting
 # See: https://lancellc.gitbook.io/clash/clash-config-file/script
 def main(ctx, metadata):
-    _, rule = match(ctx, metadata)
+    if PROFILE > 0 and int(metadata["src_port"]) % PROFILE == 0:
+        _, rule = profile(ctx, metadata)
+    else:
+        _, rule = match(ctx, metadata)
     if rule != nil:
         out = [
             "[{0}]".format(metadata["network"].upper()),
@@ -0,0 +1,393 @@
+from benchmark import POLICIES, Context, address, load, synthesize
+from clashdog import AddRules, Builder
+
+# 标准库
+import ipaddress
+import random
+import re
+import types
+
+from urllib.parse import urlparse
+
+
+def render(*inserts, optimize=True, hits=None):
+    # inserts: (filter, rules)，按顺序合并
+    AddRules._Rules = [None] * len(inserts)
+    AddRules._Same = {}
+    for push, (filter, rules) in enumerate(inserts):
+        AddRules(
+            types.SimpleNamespace(
+                push=push,
+                filter=filter,
+                text="rules:\n" + "".join(f"  - {x}\n" for x in rules),
+                policies=POLICIES,
+                defaultPolicy="DIRECT",
+                url=urlparse(f"file:///test{push}"),
+            )
+        )
+    return load(Builder.render(hits=hits, optimize=optimize))
+
+
+def connection(host="", dst_ip="", src_ip="10.0.0.1"):
+    return {
+        "type": "SOCKS5",
+        "network": "tcp",
+        "host": host,
+        "src_ip": src_ip,
+        "src_port": "50000",
+        "dst_ip": dst_ip,
+        "dst_port": "443",
+    }
+
+
+def test_same_keeps_dst_ip_rules_after_resolve():
+    # 第 0 条与第 9 条相同，但第 2 条解析域名后第 9 条看到的目标 IP 不同
+    g = render(
+        (
+            ["off"],
+            [
+                "IP-CIDR,1.2.3.0/24,DIRECT,no-resolve",
+                "DOMAIN,a.example.com,A",
+                "SRC-IP-CIDR,192.168.0.0/16,REJECT",
+                *[f"DOMAIN,b{i}.example.com,A" for i in range(6)],
+            ],
+        ),
+        (["same"], ["IP-CIDR,1.2.3.0/24,DIRECT,no-resolve", "MATCH,G"]),
+    )
+    assert [x[0] for x in g["RULES"]].count("IP-CIDR,1.2.3.0/24,DIRECT,no-resolve") == 2
+
+    ctx = Context(sorted(POLICIES), ["/usr/bin/curl"])
+    ctx.resolve_ip = lambda host: "1.2.3.4" if host == "q.y.x.org" else ""
+    assert g["main"](ctx, connection(host="q.y.x.org")) == "DIRECT"
+    assert (
+        g["main"](ctx, connection(host="q.y.x.org", src_ip="192.168.1.1")) == "REJECT"
+    )
+    assert g["main"](ctx, connection(dst_ip="1.2.3.4")) == "DIRECT"
+
+
+def test_same_drops_duplicates_before_resolve():
+    g = render(
+        (["off"], ["DOMAIN,a.example.com,A", "IP-CIDR,1.2.3.0/24,DIRECT,no-resolve"]),
+        (
+            ["same"],
+            [
+                "DOMAIN,a.example.com,A",
+                "IP-CIDR,1.2.3.0/24,DIRECT,no-resolve",
+                "MATCH,G",
+            ],
+        ),
+    )
+    assert [x[0] for x in g["RULES"]] == [
+        "DOMAIN,a.example.com,A",
+        "IP-CIDR,1.2.3.0/24,DIRECT,no-resolve",
+        "MATCH,G",
+    ]
+
+
+def test_shake_drops_fold_tables():
+    # 只有 PROCESS 及 GEOIP 规则需要折叠，其余规则集不应带上 unicode 折叠表
+    fold = ("foldCase", "unicode_caseOrbit", "unicode_CaseRanges", "utf8_first")
+    g = render(
+        (
+            ["off"],
+            [
+                "DOMAIN,a.com,A",
+                "DOMAIN-SUFFIX,b.com,B",
+                "IP-CIDR,1.2.3.0/24,B",
+                "MATCH,G",
+            ],
+        )
+    )
+    assert not [x for x in fold if x in g]
+
+    for rule in ("GEOIP,CN,A", "PROCESS-NAME,curl,A"):
+        g = render((["off"], [rule, "MATCH,G"]))
+        assert all(x in g for x in fold), rule
+
+
+def corpus(rules, n, rng):
+    # 每个连接从随机规则中取若干字段，使各类规则及其组合都有机会命中
+    processes = [
+        "/usr/bin/curl",
+        "/usr/bin/CURL",
+        "/bin/\u212aill",
+        "/usr/bin/\u017fSH",
+        "/x/üNï.exe",
+        "C:\\x\\ssh",
+    ]
+    for _ in range(n):
+        metadata = connection(rng.choice(["", "resolve.me", "miss.invalid"]))
+        metadata["network"] = rng.choice(["tcp", "udp"])
+        metadata["dst_ip"] = rng.choice(["", "10.0.0.1", "8.8.8.8", "::1"])
+        process = rng.choice(processes)
+        for rule in rng.sample(rules, rng.choice([0, 1, 1, 2, 3])):
+            t, v = rule[1], rule[2]
+            if t in ("DOMAIN", "DOMAIN-SUFFIX"):
+                metadata["host"] = rng.choice(["", "www.", "api."]) + v
+            elif t == "DOMAIN-KEYWORD":
+                metadata["host"] = f"x{v}.com"
+            elif t == "SRC-IP-CIDR":
+                metadata["src_ip"] = address(v, rng)
+            elif "IP-CIDR" in t:
+                metadata["dst_ip"] = address(v, rng)
+            elif t == "DST-PORT":
+                metadata["dst_port"] = str(v)
+            elif t == "PROCESS-NAME":
+                process = "/usr/bin/" + rng.choice([v, v.upper()])
+        yield metadata, process
+
+
+def test_optimize_keeps_match_results():
+    # 常量折叠及裁剪前后，同一组规则对同一批连接的匹配结果应完全一致
+    # GEOIP 只返回 CN 或 US，靠前的 GEOIP 规则会吞掉大部分连接，因此放到最后
+    rules = [x for x in synthesize(300, random.Random(0)) if "GEOIP" not in x]
+    rules[-1:-1] = ["GEOIP,CN,A", "GEOIP,LAN,B,no-resolve"]
+    rules[:0] = ["PROCESS-NAME,ssh,B", "PROCESS-NAME,kill,G", "PROCESS-NAME,ÜnÏ.exe,A"]
+    plain = render((["off"], rules), optimize=False)
+    optimized = render((["off"], rules))
+    assert [x[0] for x in optimized["RULES"]] == [x[0] for x in plain["RULES"]]
+
+    rng = random.Random(0)
+    hits = set()
+    for metadata, process in corpus(plain["RULES"], 5000, rng):
+        ctx = Context(sorted(POLICIES), [process])
+        for x in ctx.proxy_providers["default"]:
+            x.alive = rng.random() < 0.8
+        expected = plain["match"](ctx, dict(metadata))
+        assert optimized["match"](ctx, dict(metadata)) == expected, metadata
+        hits.add(expected[1])
+    assert len(hits) > 100
+
+    # 折叠主要作用于 utf8 及 unicode 部分，直接对比非法 UTF-8 等输入
+    for b in byteStrings(rng, 5000):
+        assert optimized["foldRunes"](b) == plain["foldRunes"](b), b
+        assert optimized["utf8_DecodeRune"](b) == plain["utf8_DecodeRune"](b), b
+
+
+def byteStrings(rng, n):
+    # 合法的 UTF-8 中夹杂截断、过长编码、代理区及超出范围的字节序列
+    runes = (
+        "aZkKsS\u017f\u212a\u0130\u0131\u03a3\u03c3\u03c2\u00b5\u00df\u1e9e\U0001f600"
+    )
+    invalid = [
+        [0x80],
+        [0xFF],
+        [0xC0, 0x80],
+        [0xE0, 0x80, 0x80],
+        [0xED, 0xA0, 0x80],
+        [0xF4, 0x90, 0x80, 0x80],
+        [0xE2, 0x84],
+        [0xF0, 0x9F, 0x98],
+    ]
+    for _ in range(n):
+        b = []
+        for _ in range(rng.randint(0, 6)):
+            if rng.random() < 0.3:
+                b.extend(rng.choice(invalid))
+            elif rng.random() < 0.5:
+                b.extend(rng.choice(runes).encode("utf-8"))
+            else:
+                b.extend(chr(rng.randrange(0x110000)).encode("utf-8", "surrogatepass"))
+        yield b
+
+
+def test_fold_case_agrees_with_equal_fold():
+    # foldCase 用于代替 EqualFold，两者对任意字符串对的结论应一致
+    g = render((["off"], ["MATCH,G"]), optimize=False)
+    # 以 bytes 列表表示含非法 UTF-8 的 starlark 字符串
+    g["elem_ords"] = lambda s: s if isinstance(s, list) else list(s.encode("utf-8"))
+    fold, runes, equal = g["foldCase"], g["foldRunes"], g["strings_EqualFold"]
+
+    def check(s, t):
+        assert equal(s, t) == (fold(s) == fold(t)), (s, t)
+
+    for s, t in [("k", "\u212a"), ("K", "\u212a"), ("s", "\u017f"), ("k\u017f", "KS")]:
+        assert equal(s, t) and fold(s) == fold(t), (s, t)
+
+    # SimpleFold 的轨道表及 ASCII 字母，轨道内的码点两两比较，并与相邻码点比较
+    orbits = []
+    starts = [x["From"] for x in g["unicode_caseOrbit"]] + list(range(0x41, 0x5B))
+    for r in starts:
+        orbit, f = [r], g["unicode_SimpleFold"](r)
+        while f != r:
+            orbit.append(f)
+            f = g["unicode_SimpleFold"](f)
+        orbits.append(orbit)
+        for a in orbit:
+            for b in orbit + [a - 1, a + 1, a ^ 0x20]:
+                check(chr(a), chr(b))
+
+    # match 只按 ASCII 小写判断 udp，要求 u、d、p 的轨道只有大小写两个字母
+    for c in "udp":
+        assert [x for x in orbits if ord(c) in x] == [[ord(c.upper()), ord(c)]]
+        check(c.upper(), c)
+
+    rng = random.Random(0)
+    pool = [chr(x) for orbit in orbits for x in orbit] + list("éÉüÜßẞ0-_.")
+    for _ in range(20000):
+        s = "".join(rng.choice(pool) for _ in range(rng.randint(0, 5)))
+        t = "".join(
+            chr(rng.choice(orbit)) if rng.random() < 0.8 else rng.choice(pool)
+            for c in s
+            for orbit in [next((x for x in orbits if ord(c) in x), [ord(c)])]
+        )
+        check(s, t)
+
+    # 与 Go 一致，非法 UTF-8 的每个字节单独解码为 RuneError
+    for b, expected in [
+        ([0x80], "\ufffd"),
+        ([0xFF, 0x61], "\ufffdA"),
+        ([0xC0, 0x80], "\ufffd" * 2),
+        ([0xE2, 0x84], "\ufffd" * 2),
+        ([0xED, 0xA0, 0x80], "\ufffd" * 3),
+        ([0xF4, 0x90, 0x80, 0x80], "\ufffd" * 4),
+        ([0xE2, 0x84, 0xAA], "K"),
+        ([0xEF, 0xBF, 0xBD], "\ufffd"),
+    ]:
+        assert fold(b) == expected, b
+
+    # RuneError 与 U+FFFD 本身相等
+    octets = [0x41, 0x61, 0x73, 0xC3, 0xBC, 0x9C, 0xE2, 0x84, 0xAA, 0xC5, 0xBF]
+    octets += [0x80, 0xFF, 0xEF, 0xBF, 0xBD]
+    for _ in range(20000):
+        s = [rng.choice(octets) for _ in range(rng.randint(0, 6))]
+        t = [rng.choice(octets) for _ in range(rng.randint(0, 6))]
+        assert equal(s, t) == (runes(s) == runes(t)), (s, t)
+
+
+###############################################################
+# 逐条匹配的参照实现，与 clash 的 tunnel.match 相同，不使用任何索引
+###############################################################
+LAN = [ipaddress.ip_network(x) for x in ("10.0.0.0/8", "172.16.0.0/12", "192.168.0.0/16", "fc00::/7")]  # fmt: skip
+
+
+def ip(s):
+    try:
+        addr = ipaddress.ip_address(s)
+    except ValueError:
+        return None
+    return addr.ipv4_mapped or addr if addr.version == 6 else addr
+
+
+def contains(network, s):
+    addr = ip(s)
+    return addr is not None and addr.version == network.version and addr in network
+
+
+# 语料中没有 ß 等两者结论不同的字符
+def fold(s):
+    return s.upper().lower()
+
+
+def reference(ctx, metadata, rules):
+    udp = metadata["network"].lower() == "udp"
+    dst = metadata["dst_ip"]
+    resolved = False
+    process = None
+    for raw in rules:
+        t, v, *options = raw.split(",")
+        policy = v if t == "MATCH" else options.pop(0)
+
+        if not resolved and "IP" in t and "no-resolve" not in options:
+            if metadata["host"] and ip(dst) is None:
+                resolved = True
+                dst = ctx.resolve_ip(metadata["host"])
+        if t.startswith("PROCESS") and process is None:
+            process = ctx.resolve_process_name(metadata)
+
+        if t == "DOMAIN":
+            hit = metadata["host"] == v
+        elif t == "DOMAIN-SUFFIX":
+            hit = metadata["host"].endswith("." + v) or metadata["host"] == v
+        elif t == "DOMAIN-KEYWORD":
+            hit = v in metadata["host"]
+        elif t in ("IP-CIDR", "IP-CIDR6"):
+            hit = contains(ipaddress.ip_network(v), dst)
+        elif t == "SRC-IP-CIDR":
+            hit = contains(ipaddress.ip_network(v), metadata["src_ip"])
+        elif t == "GEOIP":
+            if fold(v) == fold("LAN"):
+                hit = any(contains(x, dst) for x in LAN)
+            else:
+                hit = ip(dst) is not None and fold(ctx.geoip(dst)) == fold(v)
+        elif t == "DST-PORT":
+            hit = metadata["dst_port"] == v
+        elif t == "SRC-PORT":
+            hit = metadata["src_port"] == v
+        elif t == "PROCESS-NAME":
+            hit = fold(re.split(r"[/\\]", process)[-1]) == fold(v)
+        elif t == "PROCESS-PATH":
+            hit = fold(process) == fold(v)
+        else:
+            hit = t == "MATCH"
+        if not hit:
+            continue
+
+        proxy = [x for x in ctx.proxy_providers["default"] if x.name == policy]
+        if not proxy or not proxy[0].alive:
+            continue
+        if udp and (POLICIES[policy] or "disable-udp" in options):
+            continue
+        return policy, raw
+    return "DIRECT", None
+
+
+def test_index_matches_linear_reference():
+    # 索引合并、same 去重、过滤、移除被覆盖的规则及按命中次数重排后，
+    # 结果都应与对原始规则逐条匹配相同
+    rng = random.Random(1)
+    rules = [x for x in synthesize(200, rng) if "GEOIP" not in x][:-1]
+    first = [
+        "DOMAIN-SUFFIX,shadow.com,A",
+        "DOMAIN,www.shadow.com,A",  # 被上一条覆盖，移除
+        "DOMAIN,api.shadow.com,B",  # 被覆盖但 Policy 不同，保留
+        "DOMAIN-KEYWORD,keyword,A",
+        "DOMAIN-SUFFIX,keyword.org,A",  # 被 DOMAIN-KEYWORD 覆盖，移除
+        "IP-CIDR,10.0.0.0/8,A,no-resolve",
+        "IP-CIDR,10.1.0.0/16,A,no-resolve",  # 移除
+        "IP-CIDR,10.2.0.0/16,G",  # 首条需要解析域名的规则
+        "IP-CIDR,10.4.0.0/16,B,no-resolve",  # 最热，移到上一条之前就看不到解析出的 IP
+        *rules[:100],
+        "PROCESS-NAME,ssh,B",
+        "PROCESS-NAME,kill,G",
+        "PROCESS-PATH,/x/ÜnÏ.exe,A",
+        "SRC-PORT,50000,REJECT",
+        "GEOIP,CN,A",
+        "GEOIP,LAN,B,no-resolve",
+        "IP-CIDR,10.3.0.0/16,A",
+        *rules[100:],
+    ]
+    second = rng.sample(first, 40) + ["GEOIP,US,B", "IP-CIDR,10.1.0.0/16,A", "MATCH,G"]
+
+    for inserts, raw in [
+        ([(["off"], first + ["MATCH,G"])], first + ["MATCH,G"]),
+        ([(["off"], first), (["same"], second)], first + second),
+        (
+            [(["off"], first), (["geoip", "match"], second)],
+            first + [x for x in second if "GEOIP" not in x and "MATCH" not in x],
+        ),
+    ]:
+        hot = {x: rng.randrange(100) for x in rng.sample(raw, 80)}
+        hot["IP-CIDR,10.4.0.0/16,B,no-resolve"] = 1000
+        for hits in (None, hot):
+            g = render(*inserts, hits=hits)
+            kept = [x[0] for x in g["RULES"]]
+            assert "DOMAIN,www.shadow.com,A" not in kept
+            assert "DOMAIN-SUFFIX,keyword.org,A" not in kept
+            assert "DOMAIN,api.shadow.com,B" in kept
+
+            nets = [x[2] for x in g["RULES"] if "IP-CIDR" in x[1]]
+            for metadata, process in corpus(g["RULES"], 2000, rng):
+                metadata["src_port"] = rng.choice(["50000", "50001", "60000"])
+                ctx = Context(sorted(POLICIES), [process])
+                for x in ctx.proxy_providers["default"]:
+                    x.alive = rng.random() < 0.8
+                resolved = address(rng.choice(nets), rng) if rng.random() < 0.7 else ""
+                ctx.resolve_ip = lambda host: resolved
+
+                expected = reference(ctx, metadata, raw)
+                got = tuple(g["match"](ctx, dict(metadata)))
+                # 重排只保证 Policy 不变，命中的可能是结果相同的另一条规则
+                if hits:
+                    got, expected = got[0], expected[0]
+                assert got == expected, metadata